@@ -0,0 +1,82 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import logger
+from exceptions import DeviceTimeoutError
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+
+class _Operation:
+    def __init__(self, peripheral, deadline, description):
+        self.peripheral = peripheral
+        self.deadline = deadline
+        self.description = description
+        self.expired = False
+
+
+class BleWatchdog:
+    """Enforces hard deadlines on BLE operations running in bluepy-helper.
+
+    A call blocked inside the helper (connect, waitForNotifications, ...)
+    can't always be interrupted by a signal based timeout. Once an operation
+    overruns its deadline its helper process is killed, which makes bluepy
+    return with an error the caller sees as DeviceTimeoutError.
+    """
+
+    def __init__(self, interval=0.5):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._operations = set()
+        self._thread = None
+
+    @contextmanager
+    def deadline(self, peripheral, seconds, description):
+        operation = _Operation(peripheral, time.monotonic() + seconds, description)
+        with self._lock:
+            self._operations.add(operation)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ble-watchdog", daemon=True)
+                self._thread.start()
+
+        try:
+            yield
+        except Exception as e:
+            if not operation.expired:
+                raise
+            raise DeviceTimeoutError(
+                "{} timed out after {} seconds".format(description, seconds)
+            ) from e
+        finally:
+            with self._lock:
+                self._operations.discard(operation)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            now = time.monotonic()
+            with self._lock:
+                overdue = [op for op in self._operations if op.deadline <= now]
+            for operation in overdue:
+                self._reap(operation)
+
+    def _reap(self, operation):
+        helper = getattr(operation.peripheral, "_helper", None)
+        if helper is None or helper.poll() is not None:
+            return
+
+        _LOGGER.warning(
+            "%s exceeded its deadline, killing bluepy-helper (pid %d)",
+            operation.description,
+            helper.pid,
+        )
+        operation.expired = True
+        _METRICS.increment("ble_watchdog.reaped")
+        with self._lock:
+            self._operations.discard(operation)
+        helper.kill()
+
+
+_BLE_WATCHDOG = BleWatchdog()
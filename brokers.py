@@ -0,0 +1,113 @@
+import os
+
+import logger
+from const import DEFAULT_STATE_DIR
+from mqtt import MqttClient
+
+_LOGGER = logger.get(__name__)
+
+ROLE_PRIMARY = "primary"
+ROLE_MIRROR = "mirror"
+ROLE_FAILOVER = "failover"
+
+# Workers, discovery and the payload encoders are shared by every broker
+SHARED_OPTIONS = ("topic_prefix", "encoding", "payload_codecs")
+
+class MultiBrokerClient:
+    """Publishes to several brokers at once, each through its own MqttClient.
+
+    Every broker has its own background publish queue, so a slow or
+    unreachable one does not hold back the others.
+    - primary brokers get every message and deliver the subscribed commands.
+    - mirror brokers get a copy of the messages matching their topics.
+    - failover brokers only get messages while no primary broker is
+      connected, and deliver commands too.
+    """
+
+    def __init__(self, config):
+        # Options next to the broker list apply to every broker
+        shared = {key: value for key, value in config.items() if key != "brokers"}
+        self._clients = []
+        for index, broker in enumerate(config["brokers"]):
+            broker_config = dict(shared, **broker)
+            role = broker_config.pop("role", ROLE_PRIMARY)
+            name = broker_config.setdefault("name", broker_config.get("host", str(index)))
+            for option in SHARED_OPTIONS:
+                if broker_config.get(option) != shared.get(option):
+                    raise ValueError("Broker {} can't override {}".format(name, option))
+            spool = broker_config.get("offline_spool")
+            if spool is not None:
+                # Every broker needs a spool of its own, a shared one would be replayed to all of them
+                root, ext = os.path.splitext(
+                    spool.get("path", os.path.join(DEFAULT_STATE_DIR, "mqtt_spool.db"))
+                )
+                broker_config["offline_spool"] = dict(spool, path="{}_{}{}".format(root, name, ext))
+            _LOGGER.info("Adding %s broker %s", role, name)
+            self._clients.append((role, MqttClient(broker_config)))
+
+        if not self._by_role(ROLE_PRIMARY):
+            raise ValueError("At least one broker needs the primary role")
+
+    def _by_role(self, *roles):
+        return [client for role, client in self._clients if role in roles]
+
+    def _roles(self):
+        """Roles of the brokers to publish to right now."""
+        roles = [ROLE_PRIMARY, ROLE_MIRROR]
+        if not any(client.connected for client in self._by_role(ROLE_PRIMARY)):
+            roles.append(ROLE_FAILOVER)
+        return roles
+
+    def publish(self, messages):
+        if not messages:
+            return
+        roles = self._roles()
+        for role, client in self._clients:
+            # Discovery configs also go to failover brokers, so they are ready to take over.
+            # The digests of every broker tell whether it already has them.
+            batch = messages if role in roles else [m for m in messages if m.digest is not None]
+            # Clients set the codec and the encoded payload on the messages they publish
+            client.publish([message.copy() for message in batch])
+
+    def republish(self, *args, **kwargs):
+        for client in self._by_role(*self._roles()):
+            client.republish(*args, **kwargs)
+
+    def flush(self, timeout=None):
+        return all([client.flush(timeout) for _, client in self._clients])
+
+    def add_payload_codec(self, topic_filter, codec):
+        for _, client in self._clients:
+            client.add_payload_codec(topic_filter, codec)
+
+    def callbacks_subscription(self, callbacks):
+        for role, client in self._clients:
+            client.callbacks_subscription(callbacks if role != ROLE_MIRROR else [])
+
+    @property
+    def names(self):
+        return [client.name for _, client in self._clients]
+
+    @property
+    def availability_topic(self):
+        return self._by_role(ROLE_PRIMARY)[0].availability_topic
+
+    @property
+    def last_values(self):
+        return _LastValuesGroup([client.last_values for _, client in self._clients])
+
+
+class _LastValuesGroup:
+    def __init__(self, caches):
+        self._caches = caches
+
+    def invalidate(self):
+        for cache in self._caches:
+            cache.invalidate()
+
+
+def create_client(config):
+    """MqttClient for the mqtt section, or a MultiBrokerClient when it lists brokers."""
+    if "brokers" in config:
+        return MultiBrokerClient(config)
+    return MqttClient(config)
@@ -2,3 +2,24 @@ DEFAULT_COMMAND_TIMEOUT = 35  # In seconds
 DEFAULT_PER_DEVICE_TIMEOUT = 8  # In seconds
 DEFAULT_COMMAND_RETRIES = 0
 DEFAULT_UPDATE_RETRIES = 0
+DEFAULT_METRICS_INTERVAL = 300  # In seconds
+DEFAULT_RETRY_BUDGET = 30  # Retries per minute per bluetooth adapter, 0 to disable
+DEFAULT_STATE_DIR = "state"  # Directory for caches persisted across restarts
+DEFAULT_HEARTBEAT_INTERVAL = 900  # In seconds
+DEFAULT_PUBLISH_QUEUE_SIZE = 1000  # Messages
+DEFAULT_SPOOL_SIZE = 10 * 1024 * 1024  # In bytes
+DEFAULT_SPOOL_REPLAY_RATE = 50  # Messages per second
+DEFAULT_DISCOVERY_RATE = 20  # Discovery messages per second
+DEFAULT_COMMAND_DEBOUNCE = 0  # In seconds
+DEFAULT_COMMAND_MAX_AGE = 0  # In seconds, 0 to disable
+DEFAULT_RECONNECT_MIN_DELAY = 1  # In seconds
+DEFAULT_RECONNECT_MAX_DELAY = 120  # In seconds
+DEFAULT_MESSAGE_EXPIRY = 300  # In seconds
+DEFAULT_MAX_INFLIGHT = 20  # QoS 1/2 messages awaiting acknowledgement, 0 for unlimited
+DEFAULT_MAX_QUEUED = 0  # QoS 1/2 messages queued by the MQTT client, 0 for unlimited
+DEFAULT_REFRESH_MAX_AGE = 300  # In seconds
+DEFAULT_REFRESH_STAGGER = 5  # In seconds
+DEFAULT_REPUBLISH_CHUNK = 20  # Last values republished at once
+DEFAULT_REPUBLISH_INTERVAL = 1  # In seconds, between two chunks
+DEFAULT_STATE_SNAPSHOT_INTERVAL = 60  # In seconds
+DEFAULT_STATE_SNAPSHOT_MAX_AGE = 300  # In seconds
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import namedtuple
+
+import paho.mqtt.client as mqtt
+
+import logger
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+# retain None keeps the retain flag of the message
+DeliveryPolicy = namedtuple("DeliveryPolicy", ["name", "qos", "retain"])
+
+DEFAULT_POLICY = DeliveryPolicy("default", 0, None)
+
+
+class DeliveryPolicies:
+    """QoS and retain flag per topic filter, the first matching filter wins.
+
+    Meant to get acknowledged delivery for the few topics which need it, like
+    command state echoes, while high-rate telemetry stays fire-and-forget.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filters = []
+        self._by_topic = {}
+
+    def add(self, topic_filter, qos=0, retain=None, name=None):
+        if qos not in (0, 1, 2):
+            raise ValueError("Invalid QoS {} for {}".format(qos, topic_filter))
+        with self._lock:
+            self._filters.append((topic_filter, DeliveryPolicy(name or topic_filter, qos, retain)))
+            self._by_topic = {}
+
+    def policy_for(self, topic):
+        try:
+            return self._by_topic[topic]
+        except KeyError:
+            pass
+        with self._lock:
+            policy = next(
+                (policy for topic_filter, policy in self._filters if mqtt.topic_matches_sub(topic_filter, topic)),
+                DEFAULT_POLICY,
+            )
+            self._by_topic[topic] = policy
+        return policy
+
+
+class DeliveryTracker:
+    """Delivery time of published messages, per policy.
+
+    For QoS 0 that is the time until the message was written to the socket,
+    for QoS 1 and 2 until the PUBACK or PUBCOMP of the broker. on_publish is
+    the client's callback; it may run before sent() recorded the message id,
+    so such early acknowledgements are matched up in sent().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._acked = set()
+
+    def sent(self, info, policy, started):
+        """Track the MQTTMessageInfo returned by publishing a message with policy."""
+        if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            _METRICS.increment("mqtt.queue_full")
+            return
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and policy.qos == 0:
+            # Dropped by the client, it is never acknowledged
+            return
+
+        with self._lock:
+            acked = info.mid in self._acked
+            if acked:
+                self._acked.discard(info.mid)
+            else:
+                # Message ids wrap around, an entry never acknowledged gets replaced
+                self._pending[info.mid] = (policy.name, started)
+        if acked:
+            self._observe(policy.name, started)
+
+    # noinspection PyUnusedLocal
+    def on_publish(self, client, userdata, mid):
+        with self._lock:
+            pending = self._pending.pop(mid, None)
+            if pending is None:
+                self._acked.add(mid)
+                return
+        self._observe(*pending)
+
+    @staticmethod
+    def _observe(name, started):
+        _METRICS.observe("mqtt.delivery.{}".format(name), time.monotonic() - started)
@@ -0,0 +1,50 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from exceptions import DeviceTimeoutError
+from metrics import _METRICS
+
+
+class DeviceLockManager:
+    """Registry of per-MAC locks serializing access to a single BLE device.
+
+    Locks are re-entrant, so a command that triggers a status update of the
+    same device from within the locked section doesn't dead-lock itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _get(self, mac):
+        with self._lock:
+            return self._locks.setdefault(mac, threading.RLock())
+
+    @contextmanager
+    def acquire(self, mac, timeout=None):
+        mac = mac.upper()
+        lock = self._get(mac)
+
+        if not lock.acquire(blocking=False):
+            _METRICS.increment("device_lock.contended")
+            _METRICS.increment("device_lock.contended.{}".format(mac))
+            start = time.monotonic()
+            acquired = lock.acquire(timeout=-1 if timeout is None else timeout)
+            _METRICS.observe("device_lock.wait", time.monotonic() - start)
+            if not acquired:
+                _METRICS.increment("device_lock.timeouts")
+                raise DeviceTimeoutError(
+                    "Timed out after {} seconds waiting for device {}".format(
+                        timeout, mac
+                    )
+                )
+
+        _METRICS.increment("device_lock.acquired")
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+_DEVICE_LOCKS = DeviceLockManager()
@@ -0,0 +1,323 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import logger
+from const import DEFAULT_DISCOVERY_RATE
+from metrics import _METRICS
+from mqtt import MqttConfigMessage, MqttMessage, Topic
+from utils import load_json, save_json
+
+_LOGGER = logger.get(__name__)
+
+MODE_ENTITY = "entity"
+MODE_DEVICE = "device"
+
+# Digest sections: configs from the workers' config(), and ones emitted while polling
+SECTION_CONFIG = "config"
+SECTION_POLLING = "polling"
+
+ORIGIN = {"name": "bt-mqtt-gateway", "url": "https://github.com/zewelor/bt-mqtt-gateway"}
+
+# Abbreviations accepted by Home Assistant MQTT discovery for the keys used by the workers
+ABBREVIATIONS = {
+    "availability_topic": "avty_t",
+    "command_topic": "cmd_t",
+    "current_temperature_topic": "curr_temp_t",
+    "device": "dev",
+    "device_class": "dev_cla",
+    "icon": "ic",
+    "json_attributes_topic": "json_attr_t",
+    "mode_command_topic": "mode_cmd_t",
+    "mode_state_topic": "mode_stat_t",
+    "origin": "o",
+    "payload_available": "pl_avail",
+    "payload_not_available": "pl_not_avail",
+    "payload_off": "pl_off",
+    "payload_on": "pl_on",
+    "platform": "p",
+    "position_closed": "pos_clsd",
+    "position_open": "pos_open",
+    "position_topic": "pos_t",
+    "preset_mode_command_topic": "pr_mode_cmd_t",
+    "preset_mode_state_topic": "pr_mode_stat_t",
+    "preset_modes": "pr_modes",
+    "set_position_topic": "set_pos_t",
+    "state_class": "stat_cla",
+    "state_topic": "stat_t",
+    "temperature_command_topic": "temp_cmd_t",
+    "temperature_state_topic": "temp_stat_t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+DEVICE_ABBREVIATIONS = {
+    "connections": "cns",
+    "hw_version": "hw",
+    "identifiers": "ids",
+    "manufacturer": "mf",
+    "model": "mdl",
+    "suggested_area": "sa",
+    "sw_version": "sw",
+}
+
+
+def abbreviate(payload, abbreviations=ABBREVIATIONS):
+    return {abbreviations.get(key, key): value for key, value in payload.items()}
+
+
+def device_discovery(messages, origin=ORIGIN):
+    """Merge per-entity discovery messages into one device discovery message per node.
+
+    Messages which cannot be merged (no device, no payload, unexpected topic)
+    are returned unchanged after the merged ones.
+    """
+    devices = OrderedDict()
+    passthrough = []
+    for message in messages:
+        parts = message.topic.split("/")
+        payload = message.raw_payload
+        if len(parts) != 4 or not isinstance(payload, dict) or "device" not in payload:
+            passthrough.append(message)
+            continue
+
+        component, node_id, object_id, _ = parts
+        entity = dict(payload)
+        device = entity.pop("device")
+        if node_id not in devices:
+            devices[node_id] = {
+                "dev": abbreviate(device, DEVICE_ABBREVIATIONS),
+                "o": origin,
+                "cmps": OrderedDict(),
+            }
+        entity["platform"] = component
+        devices[node_id]["cmps"][object_id] = abbreviate(entity)
+
+    return [
+        MqttConfigMessage(MODE_DEVICE, node_id, payload=payload)
+        for node_id, payload in devices.items()
+    ] + passthrough
+
+
+class DiscoveryDigests:
+    """Digests of the discovery payloads last published, persisted across restarts.
+
+    Retained discovery messages stay on the broker, so a config whose payload
+    did not change since the last run does not have to be published again.
+    Non-retained messages are always passed through. Every broker has digests
+    of its own (a file with a _<name> suffix when publishing to several), and
+    a client checks them right before publishing with message.digest. A
+    digest is only stored once the client took its message, a message dropped
+    on the way is published again on the next run. Remove the digest files to
+    force a full republish.
+    """
+
+    def __init__(self, path=None, brokers=(None,)):
+        self._lock = threading.Lock()
+        self._path = path
+        self._brokers = list(brokers)
+        self._digests = {}
+
+    def configure(self, path, brokers=(None,)):
+        with self._lock:
+            self._path = path
+            self._brokers = list(brokers)
+            self._digests = {}
+
+    def filter(self, messages, section=SECTION_CONFIG):
+        """Messages whose payload changed on at least one broker since it was last published.
+
+        :param messages: discovery messages, with their final topic
+        :param section: digests to compare against, pruning only affects its own section
+        """
+        changed = []
+        with self._lock:
+            for message in messages:
+                if not message.retain:
+                    changed.append(message)
+                    continue
+                topic = self.topic(message)
+                digest = hashlib.sha1(message.payload).hexdigest()
+                if any(self._stored(broker, section, topic) != digest for broker in self._brokers):
+                    message.digest = partial(self.pending, section, topic, digest)
+                    changed.append(message)
+
+        _METRICS.increment("discovery.unchanged", len(messages) - len(changed))
+        return changed
+
+    def prune(self, topics, section=SECTION_CONFIG):
+        """Messages clearing the configs published before but missing from topics."""
+        with self._lock:
+            removed = []
+            for broker in self._brokers:
+                removed.extend(
+                    topic
+                    for topic in self._load(broker).get(section, {})
+                    if topic not in topics and topic not in removed
+                )
+
+        _METRICS.increment("discovery.removed", len(removed))
+        messages = []
+        for topic in removed:
+            message = MqttMessage(topic=Topic(topic, topic), payload="", retain=True)
+            message.digest = partial(self.pending, section, topic, None)
+            messages.append(message)
+        return messages
+
+    def pending(self, section, topic, digest, broker):
+        """Callback storing the digest once published, None when the broker already has it."""
+        with self._lock:
+            if self._stored(broker, section, topic) == digest:
+                return None
+        return partial(self.commit, broker, section, topic, digest)
+
+    def commit(self, broker, section, topic, digest):
+        """Store the digest of a published config, None once it was cleared."""
+        with self._lock:
+            digests = self._load(broker).setdefault(section, {})
+            if digest is None:
+                digests.pop(topic, None)
+            else:
+                digests[topic] = digest
+            self._save(broker)
+
+    @staticmethod
+    def topic(message):
+        return message.topic.qualified if isinstance(message.topic, Topic) else message.topic
+
+    def _stored(self, broker, section, topic):
+        return self._load(broker).get(section, {}).get(topic)
+
+    def _broker_path(self, broker):
+        if not self._path or broker is None:
+            return self._path
+        root, ext = os.path.splitext(self._path)
+        return "{}_{}{}".format(root, broker, ext)
+
+    def _load(self, broker):
+        if broker not in self._digests:
+            self._digests[broker] = {}
+            path = self._broker_path(broker)
+            if path:
+                try:
+                    self._digests[broker] = self._migrate(load_json(path, {}))
+                except (OSError, ValueError) as e:
+                    _LOGGER.warning("Ignoring unreadable discovery digests %s: %s", path, e)
+        return self._digests[broker]
+
+    @staticmethod
+    def _migrate(digests):
+        # Files written before polling digests were added map topics straight
+        # to digests, those all belong to the config section.
+        flat = {topic: digest for topic, digest in digests.items() if isinstance(digest, str)}
+        if flat:
+            _LOGGER.info("Migrating %d discovery digests to the config section", len(flat))
+            digests = {section: topics for section, topics in digests.items() if isinstance(topics, dict)}
+            digests.setdefault(SECTION_CONFIG, {}).update(flat)
+        return digests
+
+    def _save(self, broker):
+        path = self._broker_path(broker)
+        if not path:
+            return
+        try:
+            save_json(path, self._digests[broker])
+        except OSError as e:
+            _LOGGER.warning("Unable to save discovery digests %s: %s", path, e)
+
+
+_DISCOVERY_DIGESTS = DiscoveryDigests()
+
+
+class DiscoveryPublisher:
+    """Publishes discovery configs from a background thread, at a limited rate.
+
+    Config commands still run on the main loop (their timeouts need it) and
+    hand their messages over with add(). Once every expected command reported
+    complete results, configs which were not part of this run are cleared.
+    """
+
+    def __init__(self, mqtt, topic="homeassistant", retain=True, mode=MODE_ENTITY, rate=DEFAULT_DISCOVERY_RATE):
+        self._mqtt = mqtt
+        self._topic = topic
+        self._retain = retain
+        self._mode = mode
+        self._interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._failed = False
+        self._seen = set()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def topic_filter(self):
+        """Filter matching every discovery topic published."""
+        return "{}/#".format(self._topic)
+
+    def expect(self, count):
+        with self._lock:
+            self._pending = count
+            self._failed = False
+            self._seen = set()
+
+    def add(self, messages, complete=True, then=None):
+        """Hand over the messages of one config command.
+
+        :param messages: None when the command failed
+        :param complete: False for the partial results of a timed out command
+        :param then: called once the messages were published, e.g. to start polling their worker
+        """
+        if messages is None or not complete:
+            with self._lock:
+                self._failed = True
+        if messages is None:
+            messages = []
+        elif self._mode == MODE_DEVICE:
+            messages = device_discovery(messages)
+
+        for message in messages:
+            message.topic = "{}/{}".format(self._topic, message.topic)
+            message.retain = self._retain
+
+        if self._retain:
+            with self._lock:
+                self._seen.update(_DISCOVERY_DIGESTS.topic(message) for message in messages)
+            # Unchanged configs are still retained on the broker from the last run
+            messages = _DISCOVERY_DIGESTS.filter(messages)
+
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0 and self._retain and not self._failed:
+                messages += _DISCOVERY_DIGESTS.prune(self._seen)
+
+        for message in messages:
+            self._queue.put(message)
+        if then is not None:
+            self._queue.put(then)
+        if messages or then is not None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="discovery-publisher", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if not isinstance(item, MqttMessage):
+                item()
+                continue
+            self._mqtt.publish([item])
+            _METRICS.gauge("discovery.queue_depth", self._queue.qsize())
+            if self._interval:
+                time.sleep(self._interval)
@@ -0,0 +1,130 @@
+import importlib
+import json
+import threading
+
+import paho.mqtt.client as mqtt
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+BACKENDS = ("orjson", "ujson", "json")
+
+CODEC_JSON = "json"
+CODEC_CBOR = "cbor"
+CODEC_MSGPACK = "msgpack"
+
+
+class JsonEncoder:
+    """Serializes payloads with the fastest JSON library available.
+
+    orjson and ujson are used when installed, the standard library otherwise.
+    Both third party libraries always produce compact output.
+    """
+
+    def __init__(self):
+        self._float_precision = None
+        self._dumps = None
+        self.configure()
+
+    def configure(self, backend=None, compact=False, float_precision=None):
+        self._float_precision = float_precision
+        for name in (backend,) if backend else BACKENDS:
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                if backend:
+                    _LOGGER.warning("JSON backend %s is not installed, using json", backend)
+                    return self.configure(None, compact, float_precision)
+                continue
+            self.backend = name
+            break
+
+        if self.backend == "orjson":
+            self._dumps = module.dumps
+        elif self.backend == "ujson":
+            self._dumps = lambda obj: module.dumps(obj, ensure_ascii=False).encode("utf-8")
+        else:
+            separators = (",", ":") if compact else None
+            self._dumps = lambda obj: json.dumps(obj, separators=separators).encode("utf-8")
+        _LOGGER.debug("Using %s for JSON encoding", self.backend)
+
+    def dumps(self, obj):
+        """Encode obj to JSON bytes."""
+        if self._float_precision is not None:
+            obj = self._round(obj)
+        return self._dumps(obj)
+
+    def _round(self, obj):
+        if isinstance(obj, float):
+            return round(obj, self._float_precision)
+        if isinstance(obj, dict):
+            return {k: self._round(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self._round(v) for v in obj]
+        return obj
+
+
+_JSON_ENCODER = JsonEncoder()
+
+
+class PayloadCodecs:
+    """Payload codec per topic filter, JSON for every topic without one.
+
+    Binary codecs are meant for high-rate topics read by our own services:
+    the payload is the CBOR or MessagePack encoding of the value which would
+    otherwise be published as JSON. String payloads are always sent as UTF-8
+    text, whatever the codec.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filters = []
+        self._by_topic = {}
+        self._encoders = {CODEC_JSON: _JSON_ENCODER.dumps}
+
+    def add(self, topic_filter, codec):
+        encoder = self._encoders.get(codec) or self._load(codec)
+        if encoder is None:
+            return
+        with self._lock:
+            self._encoders[codec] = encoder
+            self._filters.append((topic_filter, codec))
+            self._by_topic = {}
+
+    def codec_for(self, topic):
+        """Codec of the first filter matching topic, None when no filter matches."""
+        try:
+            return self._by_topic[topic]
+        except KeyError:
+            pass
+        with self._lock:
+            codec = next(
+                (codec for topic_filter, codec in self._filters if mqtt.topic_matches_sub(topic_filter, topic)),
+                None,
+            )
+            self._by_topic[topic] = codec
+        return codec
+
+    def dumps(self, codec, obj):
+        return self._encoders[codec](obj)
+
+    @staticmethod
+    def _load(codec):
+        try:
+            if codec == CODEC_CBOR:
+                import cbor2
+
+                return cbor2.dumps
+            if codec == CODEC_MSGPACK:
+                import msgpack
+
+                return lambda obj: msgpack.packb(obj, use_bin_type=True)
+        except ImportError as e:
+            _LOGGER.warning("Payload codec %s is not installed (%s), using JSON", codec, e)
+            return None
+        _LOGGER.warning("Unknown payload codec %s, using JSON", codec)
+        return None
+
+
+_PAYLOAD_CODECS = PayloadCodecs()
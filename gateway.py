@@ -18,7 +18,7 @@ import queue
 
 import workers_requirements
 from workers_queue import _WORKERS_QUEUE
-from mqtt import MqttClient
+from brokers import create_client
 from workers_manager import WorkersManager
 
 
@@ -78,7 +78,7 @@ workers_requirements.verify()
 
 global_topic_prefix = settings["mqtt"].get("topic_prefix")
 
-mqtt = MqttClient(settings["mqtt"])
+mqtt = create_client(settings["mqtt"])
 manager = WorkersManager(settings["manager"], mqtt)
 manager.register_workers(global_topic_prefix)
 manager.start()
@@ -106,3 +106,6 @@ while running:
             _LOGGER, "Fatal error while executing worker command: %s", type(e).__name__
         )
         raise e
+
+manager.save_state()
+mqtt.flush(timeout=5)
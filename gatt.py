@@ -0,0 +1,183 @@
+import threading
+import time
+
+import logger
+from ble_watchdog import _BLE_WATCHDOG
+from device_locks import _DEVICE_LOCKS
+from metrics import _METRICS
+from utils import load_json, save_json
+
+_LOGGER = logger.get(__name__)
+
+_READ = "read"
+_WRITE = "write"
+_WAIT = "wait"
+
+
+class _NotificationCollector:
+    def __init__(self):
+        self.notifications = []
+
+    def handleNotification(self, handle, data):
+        self.notifications.append((handle, data))
+
+
+class GattPipeline:
+    """Queue of GATT reads, writes and notification waits run over one connection.
+
+    Operations are queued with read(), write() and wait_notifications() and
+    executed in order by run(), which connects once, holds the device lock and
+    enforces a single deadline for the whole batch. run() returns one result
+    per read (the value) and per wait (list of (handle, data) notifications);
+    writes don't produce a result.
+    """
+
+    def __init__(self, mac, addr_type="public", iface=None, lock_timeout=None, description=None):
+        self.mac = mac
+        self.addr_type = addr_type
+        self.iface = iface
+        self.lock_timeout = lock_timeout
+        self.description = description or "device {}".format(mac)
+        self._operations = []
+
+    def read(self, handle):
+        self._operations.append((_READ, (handle,)))
+        return self
+
+    def write(self, handle, data, with_response=False):
+        self._operations.append((_WRITE, (handle, data, with_response)))
+        return self
+
+    def wait_notifications(self, timeout):
+        self._operations.append((_WAIT, (timeout,)))
+        return self
+
+    def run(self, timeout):
+        from bluepy import btle
+
+        collector = _NotificationCollector()
+        results = []
+        deadline = time.monotonic() + timeout
+
+        with _DEVICE_LOCKS.acquire(self.mac, timeout=self.lock_timeout):
+            device = btle.Peripheral()
+            with _BLE_WATCHDOG.deadline(device, timeout, self.description):
+                device.connect(self.mac, self.addr_type, self.iface)
+                try:
+                    device.withDelegate(collector)
+                    for operation, args in self._operations:
+                        if operation == _READ:
+                            results.append(device.readCharacteristic(*args))
+                        elif operation == _WRITE:
+                            device.writeCharacteristic(*args)
+                        else:
+                            collector.notifications = []
+                            device.waitForNotifications(
+                                max(0.0, min(args[0], deadline - time.monotonic()))
+                            )
+                            results.append(collector.notifications)
+                finally:
+                    device.disconnect()
+
+        _LOGGER.debug(
+            "Ran %d GATT operations on %s in one connection",
+            len(self._operations),
+            self.description,
+        )
+        return results
+
+
+class HandleCache:
+    """Characteristic handles discovered per device, persisted across restarts.
+
+    Handles are keyed by MAC, so later connections can write straight to a
+    known handle instead of walking services and characteristics. A full
+    discovery only happens on a cache miss or when a cached handle turns out
+    to be stale.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._path = path
+        self._handles = None
+
+    def configure(self, path):
+        with self._lock:
+            self._path = path
+            self._handles = None
+
+    def get(self, mac, uuid):
+        with self._lock:
+            return self._load().get(mac.upper(), {}).get(uuid)
+
+    def update(self, mac, handles):
+        with self._lock:
+            self._load().setdefault(mac.upper(), {}).update(handles)
+            self._save()
+
+    def invalidate(self, mac):
+        _METRICS.increment("gatt_cache.invalidations")
+        with self._lock:
+            if self._load().pop(mac.upper(), None) is not None:
+                self._save()
+
+    def resolve(self, device, mac, uuids):
+        """Handles of the characteristics with the given (short or full) UUIDs.
+
+        Raises BTLEGattError when the device has no characteristic for one of them.
+        """
+        from bluepy import btle
+
+        handles = {uuid: self.get(mac, uuid) for uuid in uuids}
+        missing = {btle.UUID(uuid): uuid for uuid, handle in handles.items() if handle is None}
+        if not missing:
+            _METRICS.increment("gatt_cache.hits")
+            return handles
+
+        _METRICS.increment("gatt_cache.misses")
+        _LOGGER.debug("Discovering characteristics %s of %s", list(missing.values()), mac)
+        for characteristic in device.getCharacteristics():
+            uuid = missing.pop(characteristic.uuid, None)
+            if uuid is not None:
+                handles[uuid] = characteristic.getHandle()
+        self.update(mac, {uuid: handle for uuid, handle in handles.items() if handle is not None})
+        if missing:
+            raise btle.BTLEGattError(
+                "Characteristics {} not found on {}".format(", ".join(missing.values()), mac)
+            )
+        return handles
+
+    def write_characteristic(self, device, mac, uuid, data, with_response=False):
+        from bluepy import btle
+
+        handle = self.get(mac, uuid)
+        if handle is not None:
+            try:
+                return device.writeCharacteristic(handle, data, with_response)
+            except btle.BTLEGattError as e:
+                _LOGGER.debug("Cached handle %d of %s failed (%s), rediscovering", handle, mac, e)
+                self.invalidate(mac)
+
+        handle = self.resolve(device, mac, [uuid])[uuid]
+        return device.writeCharacteristic(handle, data, with_response)
+
+    def _load(self):
+        if self._handles is None:
+            self._handles = {}
+            if self._path:
+                try:
+                    self._handles = load_json(self._path, {})
+                except (OSError, ValueError) as e:
+                    _LOGGER.warning("Ignoring unreadable GATT handle cache %s: %s", self._path, e)
+        return self._handles
+
+    def _save(self):
+        if not self._path:
+            return
+        try:
+            save_json(self._path, self._handles)
+        except OSError as e:
+            _LOGGER.warning("Unable to save GATT handle cache %s: %s", self._path, e)
+
+
+_HANDLE_CACHE = HandleCache()
@@ -0,0 +1,96 @@
+import numbers
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from const import DEFAULT_HEARTBEAT_INTERVAL
+from metrics import _METRICS
+
+
+class _Entry:
+    __slots__ = ("payload", "raw_payload", "retain", "published_at", "generation")
+
+    def __init__(self, payload, raw_payload, retain, published_at, generation):
+        self.payload = payload
+        self.raw_payload = raw_payload
+        self.retain = retain
+        self.published_at = published_at
+        self.generation = generation
+
+
+class LastValueCache:
+    """Last payload published per topic.
+
+    With change-only publishing enabled, a message is suppressed when its
+    payload equals the last published one, or for numeric payloads when it
+    stays within the deadband configured for the topic. Values are
+    republished anyway once they have been silent for the heartbeat interval.
+    """
+
+    def __init__(self, config=None, format_topic=lambda topic: topic):
+        self.enabled = config is not None
+        config = config or {}
+        self._heartbeat = config.get("heartbeat", DEFAULT_HEARTBEAT_INTERVAL)
+        self._deadbands = [
+            (format_topic(pattern), deadband)
+            for pattern, deadband in (config.get("deadbands") or {}).items()
+        ]
+        self._deadband_by_topic = {}
+        self._lock = threading.Lock()
+        self._values = {}
+        self._generation = 0
+
+    def should_publish(self, topic, message):
+        now = time.monotonic()
+        with self._lock:
+            last = self._values.get(topic)
+            if (
+                self.enabled
+                and last is not None
+                and last.generation == self._generation
+                and now - last.published_at < self._heartbeat
+                and self._unchanged(topic, last, message)
+            ):
+                _METRICS.increment("mqtt.suppressed")
+                return False
+
+            self._values[topic] = _Entry(
+                message.payload, message.raw_payload, message.retain, now, self._generation
+            )
+            return True
+
+    def values(self):
+        """(topic, payload, retain) of the last message published to every topic."""
+        with self._lock:
+            return [(topic, entry.payload, entry.retain) for topic, entry in self._values.items()]
+
+    def invalidate(self):
+        """Let the next value of every topic through, even if it's unchanged."""
+        with self._lock:
+            self._generation += 1
+
+    def _unchanged(self, topic, last, message):
+        deadband = self._deadband(topic)
+        if deadband and self._is_number(last.raw_payload) and self._is_number(message.raw_payload):
+            delta = abs(message.raw_payload - last.raw_payload)
+            if "absolute" in deadband:
+                return delta <= deadband["absolute"]
+            return delta <= abs(last.raw_payload) * deadband.get("relative", 0)
+        return last.payload == message.payload and last.retain == message.retain
+
+    def _deadband(self, topic):
+        if topic not in self._deadband_by_topic:
+            self._deadband_by_topic[topic] = next(
+                (
+                    deadband
+                    for pattern, deadband in self._deadbands
+                    if mqtt.topic_matches_sub(pattern, topic)
+                ),
+                None,
+            )
+        return self._deadband_by_topic[topic]
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, numbers.Number) and not isinstance(value, bool)
@@ -0,0 +1,47 @@
+import threading
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and timings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            count, total, maximum = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + value, max(maximum, value))
+
+    def snapshot(self):
+        with self._lock:
+            ret = dict(self._counters)
+            ret.update(self._gauges)
+            for name, (count, total, maximum) in self._timings.items():
+                ret[name] = {
+                    "count": count,
+                    "avg": round(total / count, 4),
+                    "max": round(maximum, 4),
+                }
+        return ret
+
+    def log(self):
+        for name, value in sorted(self.snapshot().items()):
+            _LOGGER.info("%s: %s", name, value)
+
+
+_METRICS = Metrics()
@@ -1,7 +1,45 @@
-import json
+import os
+import threading
+import time
+from collections import namedtuple
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import logger
+from const import (
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_QUEUED,
+    DEFAULT_MESSAGE_EXPIRY,
+    DEFAULT_PUBLISH_QUEUE_SIZE,
+    DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_RECONNECT_MIN_DELAY,
+    DEFAULT_REPUBLISH_CHUNK,
+    DEFAULT_REPUBLISH_INTERVAL,
+    DEFAULT_SPOOL_REPLAY_RATE,
+    DEFAULT_SPOOL_SIZE,
+    DEFAULT_STATE_DIR,
+)
+from delivery import DeliveryPolicies, DeliveryTracker
+from encoding import CODEC_JSON, _JSON_ENCODER, _PAYLOAD_CODECS
+from last_value_cache import LastValueCache
+from metrics import _METRICS
+from publisher import AsyncPublisher, DROP_OLDEST
+from reconnect import ReconnectManager, ResumingSSLContext
+from router import TopicRouter
+from topic_aliases import TopicAliases
+from transport import (
+    LOOPBACK_HOST,
+    TRANSPORT_LOOPBACK,
+    TRANSPORT_TCP,
+    TRANSPORT_UNIX,
+    SocketClient,
+)
+from spool import OfflineSpool
+
+# A topic resolved ahead of time: path is relative to the global prefix,
+# qualified includes it and is published as is.
+Topic = namedtuple("Topic", ["path", "qualified"])
 
 LWT_ONLINE = "online"
 LWT_OFFLINE = "offline"
@@ -11,40 +49,306 @@ _LOGGER = logger.get(__name__)
 class MqttClient:
     def __init__(self, config):
         self._config = config
-        self._mqttc = mqtt.Client(
-            client_id=self.client_id,
-            clean_session=False,
-            userdata={"global_topic_prefix": self.topic_prefix},
-        )
+        self._topic_aliases = None
+        self._message_expiry = None
+        self._v5 = self.protocol == mqtt.MQTTv5
+        if self._v5:
+            self._mqttc = SocketClient(
+                client_id=self.client_id,
+                userdata={"global_topic_prefix": self.topic_prefix},
+                protocol=mqtt.MQTTv5,
+            )
+            if self._config.get("topic_aliases", True):
+                self._topic_aliases = TopicAliases()
+            self._message_expiry = self._config.get("message_expiry", DEFAULT_MESSAGE_EXPIRY)
+        else:
+            self._mqttc = SocketClient(
+                client_id=self.client_id,
+                clean_session=False,
+                userdata={"global_topic_prefix": self.topic_prefix},
+            )
+        if self.transport == TRANSPORT_UNIX:
+            self.mqttc.unix_socket_path = self._config["socket_path"]
 
         if self.username and self.password and not self.client_key:
             self.mqttc.username_pw_set(self.username, self.password)
 
-        if self.ca_cert and not self.client_key:
-            cert_reqs = mqtt.ssl.CERT_REQUIRED if self.ca_verify else mqtt.ssl.CERT_NONE
-            self.mqttc.tls_set(self.ca_cert, cert_reqs=cert_reqs)
+        self._ssl_context = None
+        # A local broker is reached in plain text, TLS only applies to remote ones
+        if self.ca_cert and self.transport == TRANSPORT_TCP:
+            self._ssl_context = ResumingSSLContext(mqtt.ssl.PROTOCOL_TLS_CLIENT)
+            self._ssl_context.load_verify_locations(self.ca_cert)
+            if self.client_key:
+                self._ssl_context.load_cert_chain(self.client_cert, self.client_key)
+            self.mqttc.tls_set_context(self._ssl_context)
             self.mqttc.tls_insecure_set(not self.ca_verify)
-
-        if self.ca_cert and self.client_key:
-            cert_reqs = mqtt.ssl.CERT_REQUIRED if self.ca_verify else mqtt.ssl.CERT_NONE
-            self.mqttc.tls_set(self.ca_cert, self.client_cert, self.client_key, cert_reqs=cert_reqs)
-            self.mqttc.tls_insecure_set(not self.ca_verify)            
+            if not self.ca_verify:
+                self._ssl_context.verify_mode = mqtt.ssl.CERT_NONE
 
         if self.availability_topic:
             topic = self._format_topic(self.availability_topic)
             _LOGGER.debug("Setting LWT to: %s" % topic)
             self.mqttc.will_set(topic, payload=LWT_OFFLINE, retain=True)
 
+        delivery = self._config.get("delivery", {})
+        self.mqttc.max_inflight_messages_set(delivery.get("max_inflight", DEFAULT_MAX_INFLIGHT))
+        self.mqttc.max_queued_messages_set(delivery.get("max_queued", DEFAULT_MAX_QUEUED))
+        self._delivery = DeliveryPolicies()
+        for topic_filter, policy in delivery.get("policies", {}).items():
+            self._delivery.add(
+                self._format_topic(topic_filter),
+                qos=policy.get("qos", 0),
+                retain=policy.get("retain"),
+                name=policy.get("name"),
+            )
+        self._delivery_tracker = DeliveryTracker()
+        self.mqttc.on_publish = self._delivery_tracker.on_publish
+
+        encoding = self._config.get("encoding", {})
+        _JSON_ENCODER.configure(
+            encoding.get("backend"),
+            compact=encoding.get("compact", False),
+            float_precision=encoding.get("float_precision"),
+        )
+
+        self._router = TopicRouter()
+
+        # Only publish topics matching one of these filters, everything when unset
+        self._topic_filters = None
+        if "topics" in self._config:
+            self._topic_filters = TopicRouter()
+            for topic_filter in self._config["topics"]:
+                self._topic_filters.add(self._format_topic(topic_filter), True)
+        reconnect = self._config.get("reconnect", {})
+        self._reconnect = ReconnectManager(
+            self.mqttc,
+            min_delay=reconnect.get("min_delay", DEFAULT_RECONNECT_MIN_DELAY),
+            max_delay=reconnect.get("max_delay", DEFAULT_RECONNECT_MAX_DELAY),
+        )
+
+        for topic_filter, codec in self._config.get("payload_codecs", {}).items():
+            self.add_payload_codec(topic_filter, codec)
+
+        self._last_values = LastValueCache(
+            self._config.get("change_only"), self._format_topic
+        )
+
+        self._republish_lock = threading.Lock()
+        self._republish_generation = 0
+
+        self._spool = None
+        self._replaying = False
+        self._replay_thread = None
+        spool_config = self._config.get("offline_spool")
+        if spool_config is not None:
+            self._spool = OfflineSpool(
+                spool_config.get("path", os.path.join(DEFAULT_STATE_DIR, "mqtt_spool.db")),
+                max_size=spool_config.get("max_size", DEFAULT_SPOOL_SIZE),
+            )
+            self._replay_rate = spool_config.get("replay_rate", DEFAULT_SPOOL_REPLAY_RATE)
+
+        publish_queue = self._config.get("publish_queue", {})
+        self._publisher = AsyncPublisher(
+            self._send,
+            max_size=publish_queue.get("size", DEFAULT_PUBLISH_QUEUE_SIZE),
+            overflow=publish_queue.get("overflow", DROP_OLDEST),
+            # Without a spool, messages wait in the queue until the broker accepted the connection
+            paused=self._spool is None,
+        )
+
     def publish(self, messages):
         if not messages:
             return
 
         for m in messages:
-            if m.use_global_prefix:
-                topic = self._format_topic(m.topic)
-            else:
-                topic = m.topic
-            self.mqttc.publish(topic, m.payload, retain=m.retain)
+            topic = m.topic
+            if isinstance(topic, Topic):
+                topic = topic.qualified
+            elif m.use_global_prefix:
+                topic = self._format_topic(topic)
+            if self._topic_filters is not None and not self._topic_filters.match(topic)[1]:
+                continue
+            if m.digest is not None:
+                m.on_sent = m.digest(self.name)
+                if m.on_sent is None:
+                    continue
+            if m.codec is None:
+                m.codec = _PAYLOAD_CODECS.codec_for(topic)
+            if self._last_values.should_publish(topic, m):
+                self._publish(topic, m)
+
+    def republish(self, exclude=(), chunk=DEFAULT_REPUBLISH_CHUNK, interval=DEFAULT_REPUBLISH_INTERVAL):
+        """Publish the last value of every state topic again, even if it did not change.
+
+        Retained values are still on the broker and skipped, like topics
+        matching one of the exclude filters. Values are handed to the publish
+        queue chunk at a time, interval seconds apart, so a large cache does
+        not evict fresh values from the queue.
+        """
+        excluded = TopicRouter()
+        for topic_filter in exclude:
+            excluded.add(topic_filter, True)
+        messages = [
+            MqttMessage(Topic(topic, topic), payload, retain)
+            for topic, payload, retain in self._last_values.values()
+            # Cleared topics, like removed discovery configs, stay cleared
+            if payload and not retain and not excluded.match(topic)[1]
+        ]
+        with self._republish_lock:
+            self._republish_generation += 1
+            generation = self._republish_generation
+        thread = threading.Thread(
+            target=self._republish,
+            args=(messages, generation, max(1, chunk), interval),
+            name="mqtt-republish",
+            daemon=True,
+        )
+        thread.start()
+        _LOGGER.info("Republishing the last value of %d topics", len(messages))
+
+    def _republish(self, messages, generation, chunk, interval):
+        for start in range(0, len(messages), chunk):
+            if start:
+                time.sleep(interval)
+            # A newer republish superseded this one
+            if self._republish_generation != generation:
+                return
+            for message in messages[start:start + chunk]:
+                self._publish(message.topic.qualified, message)
+            _METRICS.increment("mqtt.republished", len(messages[start:start + chunk]))
+
+    def add_payload_codec(self, topic_filter, codec):
+        """Encode the payloads published below topic_filter (without the global prefix) with codec."""
+        _PAYLOAD_CODECS.add(self._format_topic(topic_filter), codec)
+
+    def flush(self, timeout=None):
+        return self._publisher.flush(timeout)
+
+    def _publish(self, topic, message):
+        self._publisher.put(topic, message)
+
+    def _send(self, topic, message):
+        retain = self._delivery.policy_for(topic).retain
+        if retain is None:
+            retain = message.retain
+        if self._spool is not None:
+            with self._spool.lock:
+                # Keep publish order: while a replay is running new messages queue up behind it
+                if self._replaying or not self.mqttc.is_connected():
+                    self._spool.append(topic, message.payload, retain)
+                    return
+
+        if self._transmit(topic, message.payload, retain):
+            if message.on_sent is not None:
+                message.on_sent()
+            return
+        # The connection dropped since the check above, or the client's queue is full
+        if self._spool is not None:
+            self._spool.append(topic, message.payload, retain)
+            if self.mqttc.is_connected():
+                self._start_replay()
+        else:
+            _METRICS.increment("mqtt.dropped")
+            _LOGGER.debug("Not connected, dropped message for %s", topic)
+
+    def _transmit(self, topic, payload, retain, queued_at=None):
+        """Hand the message to the client, False when the client did not take it.
+
+        :param queued_at: wall clock time a spooled message was queued at, to expire it
+        """
+        policy = self._delivery.policy_for(topic)
+        started = time.monotonic()
+        if not self._v5:
+            info = self.mqttc.publish(topic, payload, qos=policy.qos, retain=retain)
+            self._delivery_tracker.sent(info, policy, started)
+            return self._accepted(info, policy)
+
+        properties = Properties(PacketTypes.PUBLISH)
+        if self._message_expiry and not retain:
+            # Readings delivered late are worse than none at all
+            expiry = self._message_expiry
+            if queued_at:
+                expiry -= time.time() - queued_at
+                if expiry < 1:
+                    _METRICS.increment("spool.expired")
+                    return True
+            properties.MessageExpiryInterval = int(expiry)
+        alias = None
+        # Unacknowledged messages are sent again after a reconnect, when the aliases are gone
+        if self._topic_aliases is not None and policy.qos == 0:
+            full_topic = topic
+            topic, alias = self._topic_aliases.resolve(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+        info = self.mqttc.publish(topic, payload, qos=policy.qos, retain=retain, properties=properties)
+        self._delivery_tracker.sent(info, policy, started)
+        if alias is not None and topic and info.rc != mqtt.MQTT_ERR_SUCCESS:
+            # The topic carrying the new alias never reached the broker
+            self._topic_aliases.release(full_topic, alias)
+        return self._accepted(info, policy)
+
+    @staticmethod
+    def _accepted(info, policy):
+        # Unlike QoS 0 ones, QoS 1/2 messages are kept by the client and sent once connected
+        return info.rc == mqtt.MQTT_ERR_SUCCESS or (
+            info.rc == mqtt.MQTT_ERR_NO_CONN and policy.qos > 0
+        )
+
+    def _publish_availability(self, payload):
+        # Never spooled, a replayed "offline" would override the current state
+        self._transmit(self._format_topic(self.availability_topic), payload, True)
+
+    def _start_replay(self):
+        with self._spool.lock:
+            if not len(self._spool):
+                # Nothing left from an interrupted replay, stop queueing behind it
+                self._replaying = False
+                return
+            self._replaying = True
+            if self._replay_thread is not None:
+                return
+            self._replay_thread = threading.Thread(
+                target=self._replay, name="mqtt-spool-replay", daemon=True
+            )
+            self._replay_thread.start()
+
+    def _replay(self):
+        interval = 1.0 / self._replay_rate if self._replay_rate else 0
+        replayed = 0
+        _LOGGER.info("Replaying %d spooled messages", len(self._spool))
+        while True:
+            batch = self._spool.peek(100)
+            with self._spool.lock:
+                if not self.mqttc.is_connected():
+                    self._replay_thread = None
+                    self._replaying = bool(len(self._spool))
+                    _LOGGER.info(
+                        "Connection lost while replaying, %d spooled messages left",
+                        len(self._spool),
+                    )
+                    return
+                if not batch and not len(self._spool):
+                    self._replaying = False
+                    self._replay_thread = None
+                    _LOGGER.info("Replayed %d spooled messages", replayed)
+                    return
+
+            sent = []
+            try:
+                for id_, topic, payload, retain, queued_at in batch:
+                    if not self.mqttc.is_connected():
+                        break
+                    if not self._transmit(topic, payload, retain, queued_at):
+                        # The client's queue is full, give it time to drain
+                        time.sleep(1)
+                        break
+                    sent.append(id_)
+                    if interval:
+                        time.sleep(interval)
+            finally:
+                self._spool.remove(sent)
+                replayed += len(sent)
+                _METRICS.increment("spool.replayed", len(sent))
 
     @property
     def client_id(self):
@@ -54,12 +358,25 @@ class MqttClient:
             else "bt-mqtt-gateway"
         )
 
+    @property
+    def protocol(self):
+        return mqtt.MQTTv5 if str(self._config.get("protocol")) == "5" else mqtt.MQTTv311
+
+    @property
+    def transport(self):
+        return self._config.get("transport", TRANSPORT_TCP)
+
     @property
     def hostname(self):
-        return self._config["host"]
+        if self.transport == TRANSPORT_TCP:
+            return self._config["host"]
+        # Only used for logging and the client's bookkeeping with a Unix socket
+        return LOOPBACK_HOST
 
     @property
     def port(self):
+        if self.transport == TRANSPORT_LOOPBACK:
+            return self._config.get("loopback_port", 1883)
         return self._config["port"] if "port" in self._config else 1883
 
     @property
@@ -93,6 +410,15 @@ class MqttClient:
         else:
             return True
 
+    @property
+    def name(self):
+        """Broker name when publishing to several brokers, None otherwise."""
+        return self._config.get("name")
+
+    @property
+    def names(self):
+        return [self.name]
+
     @property
     def topic_prefix(self):
         return self._config["topic_prefix"] if "topic_prefix" in self._config else None
@@ -109,82 +435,132 @@ class MqttClient:
     def mqttc(self):
         return self._mqttc
 
+    @property
+    def connected(self):
+        return self.mqttc.is_connected()
+
+    @property
+    def last_values(self):
+        return self._last_values
+
     # noinspection PyUnusedLocal
-    def on_connect(self, client, userdata, flags, rc):
-        if self.availability_topic:
-            self.publish(
-                [
-                    MqttMessage(
-                        topic=self.availability_topic, payload=LWT_ONLINE, retain=True
-                    )
-                ]
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != mqtt.CONNACK_ACCEPTED:
+            _LOGGER.error(
+                "Broker refused the connection: %s",
+                rc if self._v5 else mqtt.connack_string(rc),
             )
+            return
+
+        if self._topic_aliases is not None:
+            self._topic_aliases.reset(getattr(properties, "TopicAliasMaximum", 0))
+
+        self._reconnect.connected()
+        if self._ssl_context is not None:
+            self._ssl_context.remember(self.mqttc.socket())
+
+        # Subscribe again on every connect, the broker may have lost the session
+        filters = self._router.filters
+        if filters:
+            _LOGGER.debug("Subscribing to: %s" % ", ".join(filters))
+            self.mqttc.subscribe([(topic, 0) for topic in filters])
+
+        if self.availability_topic:
+            self._publish_availability(LWT_ONLINE)
+        if self._spool is not None:
+            self._start_replay()
+        self._publisher.resume()
+
+    # noinspection PyUnusedLocal
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        # With a spool, _send keeps the messages on disk until the next connect
+        if self._spool is None:
+            self._publisher.pause()
+
+    # noinspection PyUnusedLocal
+    def on_message(self, client, userdata, message):
+        levels, callbacks = self._router.match(message.topic)
+        for callback in callbacks:
+            callback(client, userdata, message, levels)
 
     def callbacks_subscription(self, callbacks):
+        """Route incoming messages to the callbacks, called with (client, userdata, message, levels)."""
         self.mqttc.on_connect = self.on_connect
-
-        self.mqttc.connect(self.hostname, port=self.port)
+        self.mqttc.on_message = self.on_message
+        self.mqttc.on_disconnect = self.on_disconnect
 
         for topic, callback in callbacks:
-            topic = self._format_topic(topic)
-            _LOGGER.debug("Subscribing to: %s" % topic)
-            self.mqttc.message_callback_add(topic, callback)
-            self.mqttc.subscribe(topic)
+            self._router.add(self._format_topic(topic), callback)
 
-        self.mqttc.loop_start()
+        self.mqttc.connect_async(self.hostname, port=self.port)
+        self._reconnect.start()
 
     def __del__(self):
         if self.availability_topic:
-            self.publish(
-                [
-                    MqttMessage(
-                        topic=self.availability_topic, payload=LWT_OFFLINE, retain=True
-                    )
-                ]
-            )
+            self._publish_availability(LWT_OFFLINE)
 
     def _format_topic(self, topic):
         return "{}/{}".format(self.topic_prefix, topic) if self.topic_prefix else topic
 
 
 class MqttMessage:
+    __slots__ = ("topic", "retain", "on_sent", "digest", "_codec", "_payload", "_encoded")
+
     use_global_prefix = True
 
-    def __init__(self, topic=None, payload=None, retain=False):
-        self._topic = topic
+    def __init__(self, topic=None, payload=None, retain=False, codec=None):
+        self.topic = topic
+        self.retain = retain
+        # Called without arguments once the client took the message
+        self.on_sent = None
+        # Called with the broker name before publishing, returns the on_sent
+        # callback or None when the broker already has this payload
+        self.digest = None
+        self._codec = codec
         self._payload = payload
-        self._retain = retain
+        self._encoded = None
 
     @property
-    def topic(self):
-        return self._topic
+    def codec(self):
+        return self._codec
 
-    @topic.setter
-    def topic(self, new_topic):
-        self._topic = new_topic
+    @codec.setter
+    def codec(self, codec):
+        if codec != self._codec:
+            # Drop a payload encoded with the previous codec, e.g. by logging the message
+            self._codec = codec
+            self._encoded = None
 
     @property
     def payload(self):
-        if isinstance(self.raw_payload, str):
-            return self.raw_payload
-        else:
-            return json.dumps(self.raw_payload)
+        """Serialized payload as bytes, encoded on first access only."""
+        if self._encoded is None:
+            payload = self._payload
+            if isinstance(payload, bytes):
+                self._encoded = payload
+            elif isinstance(payload, str):
+                self._encoded = payload.encode("utf-8")
+            elif self.codec is None or self.codec == CODEC_JSON:
+                self._encoded = _JSON_ENCODER.dumps(payload)
+            else:
+                self._encoded = _PAYLOAD_CODECS.dumps(self.codec, payload)
+        return self._encoded
 
     @property
     def raw_payload(self):
         return self._payload
 
-    @property
-    def retain(self):
-        return self._retain
-
-    @retain.setter
-    def retain(self, new_retain):
-        self._retain = new_retain
+    def copy(self):
+        """Copy for another client, which resolves its codec and calls on_sent on its own."""
+        message = MqttMessage.__new__(type(self))
+        for slot in MqttMessage.__slots__:
+            setattr(message, slot, getattr(self, slot))
+        return message
 
     @property
     def as_dict(self):
-        return {"topic": self.topic, "payload": self.payload}
+        topic = self.topic.path if isinstance(self.topic, Topic) else self.topic
+        return {"topic": topic, "payload": self.payload.decode("utf-8", "replace")}
 
     def __repr__(self):
         return self.as_dict.__str__()
@@ -193,6 +569,29 @@ class MqttMessage:
         return self.__repr__()
 
 
+class MqttMessageBatch(list):
+    """Messages of a single device, all published below one topic prefix."""
+
+    __slots__ = ("_topic", "_prefix")
+
+    def __init__(self, topic, *prefix):
+        """
+        :param topic: callable resolving topic arguments, like BaseWorker.topic
+        :param prefix: topic arguments shared by every message, usually the device name
+        """
+        super().__init__()
+        self._topic = topic
+        self._prefix = prefix
+
+    def add(self, attr, payload, retain=False):
+        self.append(
+            MqttMessage(
+                topic=self._topic(*self._prefix, attr), payload=payload, retain=retain
+            )
+        )
+        return self
+
+
 class MqttConfigMessage(MqttMessage):
     SENSOR = "sensor"
     CLIMATE = "climate"
@@ -200,7 +599,10 @@ class MqttConfigMessage(MqttMessage):
     COVER = "cover"
     SWITCH = "switch"
 
+    __slots__ = ()
+
     use_global_prefix = False
 
     def __init__(self, component, name, payload=None, retain=False):
-        super().__init__("{}/{}/config".format(component, name), payload, retain)
+        # Home Assistant only reads JSON discovery
+        super().__init__("{}/{}/config".format(component, name), payload, retain, CODEC_JSON)
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import deque
+
+import logger
+from const import DEFAULT_PUBLISH_QUEUE_SIZE
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DROP_NON_RETAINED = "drop_non_retained"
+
+
+class AsyncPublisher:
+    """Sends messages from a dedicated thread fed by a bounded queue.
+
+    Producers never block on network I/O. When the queue is full, the
+    overflow policy decides which queued message is dropped: the oldest one,
+    or the oldest non-retained one (falling back to the oldest one). While
+    paused, messages are only queued, e.g. until the client is connected.
+    """
+
+    def __init__(
+        self, send, max_size=DEFAULT_PUBLISH_QUEUE_SIZE, overflow=DROP_OLDEST, name="mqtt-publisher", paused=False
+    ):
+        if overflow not in (DROP_OLDEST, DROP_NON_RETAINED):
+            raise ValueError("Unsupported publish queue overflow policy: {}".format(overflow))
+
+        self._send = send
+        self._max_size = max_size
+        self._overflow = overflow
+        self._name = name
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._sending = False
+        self._paused = paused
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, topic, message):
+        with self._condition:
+            if len(self._queue) >= self._max_size:
+                self._drop()
+            self._queue.append((topic, message, time.monotonic()))
+            _METRICS.gauge("{}.queue_depth".format(self._name), len(self._queue))
+            self._condition.notify_all()
+
+    def pause(self):
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been handed to the client, never while paused."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queue and not self._sending, timeout
+            )
+
+    def _drop(self):
+        index = 0
+        if self._overflow == DROP_NON_RETAINED:
+            index = next(
+                (i for i, (_, message, _) in enumerate(self._queue) if not message.retain),
+                0,
+            )
+        topic, _, _ = self._queue[index]
+        del self._queue[index]
+        _METRICS.increment("{}.dropped".format(self._name))
+        _LOGGER.debug("Publish queue is full, dropped message for %s", topic)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue and not self._paused)
+                topic, message, queued_at = self._queue.popleft()
+                self._sending = True
+                _METRICS.gauge("{}.queue_depth".format(self._name), len(self._queue))
+
+            started_at = time.monotonic()
+            try:
+                self._send(topic, message)
+            except Exception as e:
+                logger.log_exception(
+                    _LOGGER, "Failed to publish message to %s: %s", topic, type(e).__name__
+                )
+            finally:
+                _METRICS.observe("{}.queue_latency".format(self._name), started_at - queued_at)
+                _METRICS.observe("{}.send_latency".format(self._name), time.monotonic() - started_at)
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
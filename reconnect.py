@@ -0,0 +1,105 @@
+import random
+import ssl
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import logger
+from const import DEFAULT_RECONNECT_MAX_DELAY, DEFAULT_RECONNECT_MIN_DELAY
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """SSL context resuming the last TLS session, so reconnects skip the full handshake."""
+
+    session = None
+
+    def wrap_socket(self, *args, **kwargs):
+        if self.session is not None and "session" not in kwargs:
+            try:
+                return super().wrap_socket(*args, session=self.session, **kwargs)
+            except ValueError:
+                # The session does not fit this connection anymore
+                self.session = None
+        return super().wrap_socket(*args, **kwargs)
+
+    def remember(self, sock):
+        """Keep the session of a connected socket for the next connection."""
+        if isinstance(sock, ssl.SSLSocket) and sock.session is not None:
+            if sock.session_reused:
+                _METRICS.increment("mqtt.tls_resumed")
+            self.session = sock.session
+
+
+class ReconnectManager:
+    """Runs the network loop of a paho client in its own thread.
+
+    Failed connection attempts are retried with exponential backoff and full
+    jitter between min_delay and max_delay, so gateways restarted together do
+    not hit the broker in lockstep. The delay only resets once the broker
+    accepted the connection.
+    """
+
+    def __init__(self, client, min_delay=DEFAULT_RECONNECT_MIN_DELAY, max_delay=DEFAULT_RECONNECT_MAX_DELAY):
+        self._client = client
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._attempt = 0
+        self._disconnected_at = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-loop", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def connected(self):
+        """To be called from on_connect once the broker accepted the connection."""
+        if self._disconnected_at is not None:
+            _METRICS.increment("mqtt.reconnects")
+            _METRICS.observe("mqtt.reconnect_time", time.monotonic() - self._disconnected_at)
+            _LOGGER.info(
+                "Reconnected to the broker after %.1f seconds and %d attempts",
+                time.monotonic() - self._disconnected_at,
+                self._attempt,
+            )
+        self._attempt = 0
+        self._disconnected_at = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if self._attempt:
+                self._stopping.wait(self._delay())
+                if self._stopping.is_set():
+                    break
+            self._attempt += 1
+            _METRICS.increment("mqtt.connect_attempts")
+            try:
+                self._client.reconnect()
+            except (OSError, ssl.SSLError) as e:
+                _LOGGER.warning(
+                    "Connecting to the broker failed (attempt %d): %s", self._attempt, e
+                )
+                self._mark_disconnected()
+                continue
+
+            rc = mqtt.MQTT_ERR_SUCCESS
+            while rc == mqtt.MQTT_ERR_SUCCESS and not self._stopping.is_set():
+                rc = self._client.loop(timeout=1.0)
+            if not self._stopping.is_set():
+                _LOGGER.warning("Lost connection to the broker: %s", mqtt.error_string(rc))
+                self._mark_disconnected()
+
+    def _mark_disconnected(self):
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+
+    def _delay(self):
+        ceiling = min(self._max_delay, self._min_delay * 2 ** (self._attempt - 1))
+        return random.uniform(self._min_delay, max(self._min_delay, ceiling))
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import deque
+
+import tenacity
+
+import logger
+from const import DEFAULT_RETRY_BUDGET
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_ADAPTER = "hci0"
+
+
+def adapter_name(adapter):
+    """hciN name of a bluetooth adapter configured by index or name, None when unset."""
+    if adapter is None or adapter == "":
+        return None
+    if isinstance(adapter, int) or str(adapter).isdigit():
+        return "hci{}".format(adapter)
+    return str(adapter)
+
+
+class RetryBudget:
+    """Caps the number of retries per minute made by all devices sharing an adapter."""
+
+    def __init__(self, retries_per_minute):
+        self.retries_per_minute = retries_per_minute
+        self._lock = threading.Lock()
+        self._spent = deque()
+
+    def spend(self):
+        if not self.retries_per_minute:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            while self._spent and now - self._spent[0] > 60:
+                self._spent.popleft()
+            if len(self._spent) >= self.retries_per_minute:
+                return False
+            self._spent.append(now)
+            return True
+
+
+class RetryBudgets:
+    def __init__(self, retries_per_minute=DEFAULT_RETRY_BUDGET):
+        self._retries_per_minute = retries_per_minute
+        self._lock = threading.Lock()
+        self._budgets = {}
+
+    def configure(self, retries_per_minute):
+        with self._lock:
+            self._retries_per_minute = retries_per_minute
+            for budget in self._budgets.values():
+                budget.retries_per_minute = retries_per_minute
+
+    def get(self, adapter=None):
+        with self._lock:
+            adapter = adapter_name(adapter) or DEFAULT_ADAPTER
+            if adapter not in self._budgets:
+                self._budgets[adapter] = RetryBudget(self._retries_per_minute)
+            return self._budgets[adapter]
+
+
+_RETRY_BUDGETS = RetryBudgets()
+
+
+class RetryPolicy:
+    """Named retry policy, built once and reused for every call.
+
+    Waits grow exponentially with a random jitter, so devices failing at the
+    same time don't retry in lockstep. Each retry is paid for from the shared
+    budget; once it's exhausted the last error is raised immediately.
+    """
+
+    def __init__(self, name, retries=0, exception_type=Exception, budget=None, min_wait=1, max_wait=30):
+        self.name = name
+        self._options = dict(
+            retries=retries, exception_type=exception_type, min_wait=min_wait, max_wait=max_wait
+        )
+        self._lock = threading.Lock()
+        self._by_adapter = {}
+        self._budget = budget if budget is not None else _RETRY_BUDGETS.get()
+        self._retrying = tenacity.Retrying(
+            wait=tenacity.wait_exponential(multiplier=min_wait, max=max_wait)
+            + tenacity.wait_random(0, min_wait),
+            retry=tenacity.retry_if_exception_type(exception_type),
+            stop=tenacity.stop_after_attempt(retries + 1) | self._budget_exhausted,
+            reraise=True,
+            before_sleep=self._log_retry,
+        )
+
+    def for_adapter(self, adapter):
+        """The same policy, paying for its retries from the budget of adapter.
+
+        For workers whose devices are configured with different adapters,
+        this policy is returned as is when adapter is unset.
+        """
+        adapter = adapter_name(adapter)
+        if adapter is None:
+            return self
+        with self._lock:
+            if adapter not in self._by_adapter:
+                self._by_adapter[adapter] = RetryPolicy(
+                    self.name, budget=_RETRY_BUDGETS.get(adapter), **self._options
+                )
+            return self._by_adapter[adapter]
+
+    def __call__(self, func, *args, **kwargs):
+        _METRICS.increment("retry.{}.calls".format(self.name))
+        try:
+            result = self._retrying(func, *args, **kwargs)
+        except Exception:
+            _METRICS.increment("retry.{}.failures".format(self.name))
+            raise
+        _METRICS.increment("retry.{}.successes".format(self.name))
+        return result
+
+    def _budget_exhausted(self, retry_state):
+        if self._budget.spend():
+            return False
+        _METRICS.increment("retry.{}.budget_exhausted".format(self.name))
+        _LOGGER.warning(
+            "Retry budget exhausted, not retrying call to %s",
+            ".".join((retry_state.fn.__module__, retry_state.fn.__name__)),
+        )
+        return True
+
+    def _log_retry(self, retry_state):
+        _METRICS.increment("retry.{}.retries".format(self.name))
+        _LOGGER.info(
+            'Call to %s failed the %s time (%s). Retrying in %s seconds',
+            '.'.join((retry_state.fn.__module__, retry_state.fn.__name__)),
+            retry_state.attempt_number,
+            type(retry_state.outcome.exception()).__name__,
+            '{:.2f}'.format(getattr(retry_state.next_action, 'sleep')))
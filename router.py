@@ -0,0 +1,57 @@
+class _Node:
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicRouter:
+    """Wildcard trie from MQTT topic filters to their callbacks.
+
+    Matching walks the trie one topic level at a time, so dispatching an
+    incoming message does not get slower as subscriptions are added.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._filters = []
+
+    @property
+    def filters(self):
+        return list(self._filters)
+
+    def add(self, topic_filter, callback):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.callbacks.append(callback)
+        if topic_filter not in self._filters:
+            self._filters.append(topic_filter)
+
+    def match(self, topic):
+        """Split topic into its levels and find the callbacks of every matching filter."""
+        levels = tuple(topic.split("/"))
+        callbacks = []
+        self._match(self._root, levels, 0, callbacks)
+        return levels, callbacks
+
+    def _match(self, node, levels, index, callbacks):
+        # Wildcards never match the first level of $SYS like topics
+        wildcards = index > 0 or not levels[0].startswith("$")
+
+        multi_level = node.children.get("#")
+        if multi_level is not None and wildcards:
+            callbacks.extend(multi_level.callbacks)
+
+        if index == len(levels):
+            callbacks.extend(node.callbacks)
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, callbacks)
+
+        single_level = node.children.get("+")
+        if single_level is not None and wildcards:
+            self._match(single_level, levels, index + 1, callbacks)
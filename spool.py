@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import time
+
+import logger
+from const import DEFAULT_SPOOL_SIZE
+from metrics import _METRICS
+
+_LOGGER = logger.get(__name__)
+
+
+class OfflineSpool:
+    """Size-capped on-disk queue of messages published while the broker is unreachable.
+
+    Messages are kept in publish order. A retained message replaces any
+    spooled retained message for the same topic, so only the latest value is
+    replayed. When the spool grows over its size, the oldest messages go first.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_SPOOL_SIZE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.RLock()
+        self._max_size = max_size
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "topic TEXT NOT NULL, "
+            "payload BLOB NOT NULL, "
+            "retain INTEGER NOT NULL, "
+            "size INTEGER NOT NULL)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if "queued_at" not in columns:
+            # Spools created before the enqueue time was recorded
+            self._db.execute("ALTER TABLE messages ADD COLUMN queued_at REAL NOT NULL DEFAULT 0")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+        if self._size:
+            _LOGGER.info("Found %d bytes of spooled messages in %s", self._size, path)
+
+    def __len__(self):
+        with self.lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def append(self, topic, payload, retain):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        size = len(topic) + len(payload)
+
+        with self.lock:
+            if retain:
+                self._size -= self._db.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM messages WHERE topic = ? AND retain = 1",
+                    (topic,),
+                ).fetchone()[0]
+                self._db.execute("DELETE FROM messages WHERE topic = ? AND retain = 1", (topic,))
+
+            self._db.execute(
+                "INSERT INTO messages (topic, payload, retain, size, queued_at) VALUES (?, ?, ?, ?, ?)",
+                (topic, payload, int(bool(retain)), size, time.time()),
+            )
+            self._size += size
+            _METRICS.increment("spool.appended")
+
+            while self._size > self._max_size:
+                oldest = self._db.execute(
+                    "SELECT id, size FROM messages ORDER BY id LIMIT 1"
+                ).fetchone()
+                self._db.execute("DELETE FROM messages WHERE id = ?", (oldest[0],))
+                self._size -= oldest[1]
+                _METRICS.increment("spool.dropped")
+
+            _METRICS.gauge("spool.size", self._size)
+
+    def peek(self, limit):
+        """Oldest spooled messages as (id, topic, payload, retain, queued_at) tuples.
+
+        queued_at is the wall clock time of append(), 0 when unknown.
+        """
+        with self.lock:
+            return [
+                (id_, topic, bytes(payload), bool(retain), queued_at)
+                for id_, topic, payload, retain, queued_at in self._db.execute(
+                    "SELECT id, topic, payload, retain, queued_at FROM messages ORDER BY id LIMIT ?",
+                    (limit,),
+                )
+            ]
+
+    def remove(self, ids):
+        if not ids:
+            return
+        with self.lock:
+            placeholders = ",".join("?" * len(ids))
+            self._size -= self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM messages WHERE id IN ({})".format(placeholders),
+                ids,
+            ).fetchone()[0]
+            self._db.execute("DELETE FROM messages WHERE id IN ({})".format(placeholders), ids)
+            _METRICS.gauge("spool.size", self._size)
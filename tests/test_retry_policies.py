@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+import retry_policies
+from retry_policies import RetryBudgets, adapter_name
+from workers import base
+from workers.base import BaseWorker
+
+
+class FlakyError(Exception):
+    pass
+
+
+class Worker(BaseWorker):
+    pass
+
+
+def worker(**kwargs):
+    return Worker(35, 1, 1, None, **kwargs)
+
+
+class RetryPolicyAdapterTest(unittest.TestCase):
+    def setUp(self):
+        # One retry per minute and adapter, no waiting between attempts
+        budgets = RetryBudgets(retries_per_minute=1)
+        for patch in (
+            mock.patch.object(retry_policies, "_RETRY_BUDGETS", budgets),
+            mock.patch.object(base, "_RETRY_BUDGETS", budgets),
+            mock.patch("time.sleep"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def attempts(self, policy):
+        calls = []
+
+        def fail():
+            calls.append(None)
+            raise FlakyError()
+
+        with self.assertRaises(FlakyError):
+            policy(fail)
+        return len(calls)
+
+    def test_adapter_name(self):
+        self.assertEqual(adapter_name(0), "hci0")
+        self.assertEqual(adapter_name("1"), "hci1")
+        self.assertEqual(adapter_name("hci2"), "hci2")
+        self.assertIsNone(adapter_name(None))
+
+    def test_workers_on_two_adapters_have_separate_budgets(self):
+        first = worker(iface=0).retry_policy("update", 1, FlakyError)
+        second = worker(interface=1).retry_policy("update", 1, FlakyError)
+
+        self.assertEqual(self.attempts(first), 2)
+        # hci0 spent its retry, hci1 did not
+        self.assertEqual(self.attempts(first), 1)
+        self.assertEqual(self.attempts(second), 2)
+
+    def test_adapter_setting_names_share_a_budget(self):
+        first = worker(adapter="hci1").retry_policy("update", 1, FlakyError)
+        second = worker(iface=1).retry_policy("update", 1, FlakyError)
+
+        self.assertEqual(self.attempts(first), 2)
+        self.assertEqual(self.attempts(second), 1)
+
+    def test_devices_on_their_own_adapter(self):
+        policy = worker(iface=0).retry_policy("update", 1, FlakyError)
+
+        self.assertEqual(self.attempts(policy), 2)
+        self.assertIs(policy.for_adapter(None), policy)
+        self.assertIs(policy.for_adapter(1), policy.for_adapter("hci1"))
+        self.assertEqual(self.attempts(policy.for_adapter(1)), 2)
+        self.assertEqual(self.attempts(policy.for_adapter(0)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
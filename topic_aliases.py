@@ -0,0 +1,61 @@
+import threading
+
+from metrics import _METRICS
+
+
+class TopicAliases:
+    """MQTT 5 topic aliases for the topics published repeatedly on one connection.
+
+    A topic gets an alias once it was published hot_after times, as long as
+    the broker's TopicAliasMaximum allows. The first publish with the alias
+    still carries the topic, later ones only the alias. Aliases only live as
+    long as the connection, reset() has to be called on every connect.
+    """
+
+    def __init__(self, hot_after=2):
+        self._lock = threading.Lock()
+        self._hot_after = hot_after
+        self._maximum = 0
+        self._aliases = {}
+        self._counts = {}
+        self._next = 1
+        self._free = []
+
+    def reset(self, maximum):
+        with self._lock:
+            self._maximum = maximum
+            self._aliases = {}
+            self._counts = {}
+            self._next = 1
+            self._free = []
+
+    def resolve(self, topic):
+        """Topic to publish and its alias, None when it has none."""
+        with self._lock:
+            alias = self._aliases.get(topic)
+            if alias is not None:
+                _METRICS.increment("mqtt.topic_alias_hits")
+                return "", alias
+
+            if len(self._aliases) >= self._maximum:
+                return topic, None
+            count = self._counts.get(topic, 0) + 1
+            if count < self._hot_after:
+                self._counts[topic] = count
+                return topic, None
+
+            self._counts.pop(topic, None)
+            if self._free:
+                alias = self._free.pop()
+            else:
+                alias = self._next
+                self._next += 1
+            self._aliases[topic] = alias
+            return topic, alias
+
+    def release(self, topic, alias):
+        """Forget an alias the broker never saw, because its publish failed."""
+        with self._lock:
+            if self._aliases.get(topic) == alias:
+                del self._aliases[topic]
+                self._free.append(alias)
@@ -0,0 +1,31 @@
+import socket
+
+import paho.mqtt.client as mqtt
+
+TRANSPORT_TCP = "tcp"
+TRANSPORT_LOOPBACK = "loopback"
+TRANSPORT_UNIX = "unix"
+
+LOOPBACK_HOST = "127.0.0.1"
+
+
+class SocketClient(mqtt.Client):
+    """paho client which can also reach a co-located broker through a Unix domain socket."""
+
+    unix_socket_path = None
+
+    def _create_socket_connection(self):
+        if self.unix_socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self._connect_timeout)
+            try:
+                sock.connect(self.unix_socket_path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+
+        sock = super()._create_socket_connection()
+        # MQTT packets are small, don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
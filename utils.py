@@ -1,3 +1,6 @@
+import json
+import os
+
 true_statement = ("y", "yes", "on", "1", "true", "t")
 
 
@@ -11,3 +14,28 @@ def booleanize(value) -> bool:
     if isinstance(value, str):
         return value.lower() in true_statement
     return bool(value)
+
+
+def load_json(path, default=None):
+    """
+    Load JSON data persisted with save_json.
+    :param path: file path, might not exist yet
+    :param default: value returned when the file doesn't exist
+    :return: loaded data
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    """
+    Atomically replace the file with JSON serialized data, creating its directory if needed.
+    :param path: file path
+    :param data: JSON serializable data
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import logger
+from utils import load_json, save_json
+
+_LOGGER = logger.get(__name__)
+
+
+class WorkerStateStore:
+    """Snapshot of the workers' in-memory device state, persisted across restarts.
+
+    Workers providing snapshot_state() are saved periodically and on
+    shutdown, and read their last snapshot back with restore() while
+    setting up, so a restart does not start every tracker from scratch.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._path = path
+        self._snapshots = None
+        self._providers = {}
+
+    def configure(self, path):
+        with self._lock:
+            self._path = path
+            self._snapshots = None
+
+    def register(self, name, provider):
+        """Include the state returned by provider() in every snapshot, stored under name."""
+        with self._lock:
+            self._providers[name] = provider
+
+    def restore(self, name):
+        """State saved by the worker before the last shutdown, None when there is none."""
+        with self._lock:
+            snapshot = self._load().get(name)
+        return snapshot["state"] if snapshot else None
+
+    def age(self, name):
+        """Seconds since the worker's state was saved, None when there is no snapshot."""
+        with self._lock:
+            snapshot = self._load().get(name)
+        return max(0.0, time.time() - snapshot["saved_at"]) if snapshot else None
+
+    def save(self):
+        with self._lock:
+            providers = dict(self._providers)
+        snapshots = {}
+        for name, provider in providers.items():
+            try:
+                snapshots[name] = {"saved_at": time.time(), "state": provider()}
+            except Exception as e:
+                logger.log_exception(_LOGGER, "Unable to snapshot the state of %s: %s", name, e)
+
+        with self._lock:
+            self._load().update(snapshots)
+            if not self._path:
+                return
+            try:
+                save_json(self._path, self._snapshots)
+            except (OSError, TypeError, ValueError) as e:
+                _LOGGER.warning("Unable to save worker state %s: %s", self._path, e)
+
+    def _load(self):
+        if self._snapshots is None:
+            self._snapshots = {}
+            if self._path:
+                try:
+                    self._snapshots = load_json(self._path, {})
+                except (OSError, ValueError) as e:
+                    _LOGGER.warning("Ignoring unreadable worker state %s: %s", self._path, e)
+        return self._snapshots
+
+
+_WORKER_STATE = WorkerStateStore()
@@ -1,10 +1,9 @@
-import json
 import time
 
 import logger
 from const import DEFAULT_PER_DEVICE_TIMEOUT
 from mqtt import MqttMessage, MqttConfigMessage
-from workers.base import BaseWorker, retry
+from workers.base import BaseWorker
 
 _LOGGER = logger.get(__name__)
 
@@ -15,13 +14,28 @@ REQUIREMENTS = [
 
 
 class Am43Worker(BaseWorker):
+    connects = True
     per_device_timeout = DEFAULT_PER_DEVICE_TIMEOUT  # type: int
     target_range_scale = 3  # type: int
     last_target_position = 255
 
     def _setup(self):
+        self._update_retry = self.retry_policy("update", self.update_retries)
+        self._command_retry = self.retry_policy("command", self.command_retries)
         self._last_position_by_device = {device['mac']: 255 for device in self.devices.values()}
         self._last_device_update = {device['mac']: 0 for device in self.devices.values()}
+        self.build_topic_table(
+            ['currentPosition', 'targetPosition', 'battery', 'positionState']
+            + ['timer{}'.format(timer_id) for timer_id in range(4)],
+            extra=[('update_interval',)],
+        )
+
+        state = self.restore_state()
+        if state:
+            self.last_target_position = state['last_target_position']
+            for mac in self._last_position_by_device.keys() & state['devices'].keys():
+                self._last_position_by_device[mac] = state['devices'][mac]['position']
+                self._last_device_update[mac] = state['devices'][mac]['updated']
 
         if not hasattr(self, 'default_update_interval'):
             self.default_update_interval = None
@@ -34,6 +48,15 @@ class Am43Worker(BaseWorker):
 
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
 
+    def snapshot_state(self):
+        return {
+            'last_target_position': self.last_target_position,
+            'devices': {
+                mac: {'position': position, 'updated': self._last_device_update[mac]}
+                for mac, position in self._last_position_by_device.items()
+            },
+        }
+
     def config(self, availability_topic):
         ret = []
         for name, data in self.devices.items():
@@ -212,36 +235,37 @@ class Am43Worker(BaseWorker):
     def create_mqtt_messages(self, device_name, device_state):
         ret = [
             MqttMessage(
-                topic=self.format_topic(device_name),
-                payload=json.dumps(device_state)
+                topic=self.topic(device_name),
+                payload=device_state
             ),
             MqttMessage(
-                topic=self.format_topic(device_name, "currentPosition"),
+                topic=self.topic(device_name, "currentPosition"),
                 payload=device_state["currentPosition"],
                 retain=True
             ),
             MqttMessage(
-                topic=self.format_topic(device_name, "targetPosition"),
+                topic=self.topic(device_name, "targetPosition"),
                 payload=device_state["targetPosition"]
             ),
             MqttMessage(
-                topic=self.format_topic(device_name, "battery"),
+                topic=self.topic(device_name, "battery"),
                 payload=device_state["battery"],
                 retain=True
             ),
             MqttMessage(
-                topic=self.format_topic(device_name, "positionState"),
+                topic=self.topic(device_name, "positionState"),
                 payload=device_state["positionState"]
             )
         ]
 
+        hass_timers = []
         for timer_id, timer in enumerate(device_state['timers']):
             hass = self.configure_device_timer(device_name, timer_id, timer)
             if hass:
-                ret.append(hass)
+                hass_timers.append(hass)
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(device_name, "timer{}".format(timer_id)),
+                    topic=self.topic(device_name, "timer{}".format(timer_id)),
                     payload='ON' if timer['enabled'] else 'OFF'
                 )
             )
@@ -249,9 +273,9 @@ class Am43Worker(BaseWorker):
         for timer_id in range(len(device_state['timers']), 4):
             hass = self.configure_device_timer(device_name, timer_id, None)
             if hass:
-                ret.append(hass)
+                hass_timers.append(hass)
 
-        return ret
+        return ret + self.changed_discovery(hass_timers)
 
     def single_device_status_update(self, device_name, data):
         _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), device_name, data["mac"])
@@ -268,7 +292,7 @@ class Am43Worker(BaseWorker):
                 if device_state['positionState'].endswith('ing') and self.default_update_interval == self.update_interval:
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.rapid_update_interval
                         )
                     )
@@ -276,7 +300,7 @@ class Am43Worker(BaseWorker):
                 elif not device_state['positionState'].endswith('ing') and self.default_update_interval != self.update_interval:
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.default_update_interval
                         )
                     )
@@ -288,7 +312,9 @@ class Am43Worker(BaseWorker):
         _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
 
         for device_name, data in self.devices.items():
-            yield retry(self.single_device_status_update, retries=self.update_retries)(device_name, data)
+            yield self._update_retry.for_adapter(data.get('iface'))(
+                self.single_device_status_update, device_name, data
+            )
 
     def set_state(self, state, device_name):
         from Zemismart import Zemismart
@@ -317,7 +343,7 @@ class Am43Worker(BaseWorker):
                     self.update_interval = self.default_update_interval
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.default_update_interval
                         )
                     )
@@ -342,7 +368,7 @@ class Am43Worker(BaseWorker):
                     self.update_interval = self.rapid_update_interval
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.rapid_update_interval
                         )
                     )
@@ -368,7 +394,7 @@ class Am43Worker(BaseWorker):
                     self.update_interval = self.rapid_update_interval
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.rapid_update_interval
                         )
                     )
@@ -428,7 +454,7 @@ class Am43Worker(BaseWorker):
                     self.update_interval = self.rapid_update_interval
                     ret.append(
                         MqttMessage(
-                            topic=self.format_topic('update_interval'),
+                            topic=self.topic('update_interval'),
                             payload=self.rapid_update_interval
                         )
                     )
@@ -452,9 +478,10 @@ class Am43Worker(BaseWorker):
 
         return ret
 
-    def handle_mqtt_command(self, topic, value):
-        topic_without_prefix = topic.replace("{}/".format(self.topic_prefix), "")
-        device_name, field, action = topic_without_prefix.split("/")
+    def handle_mqtt_command(self, topic, value, route=None):
+        if route is None:
+            route = topic.replace("{}/".format(self.topic_prefix), "").split("/")
+        device_name, field, action = route
         ret = []
 
         if device_name in self.devices:
@@ -472,10 +499,12 @@ class Am43Worker(BaseWorker):
         elif field.startswith('timer') and action == "set":
             ret += self.set_timer_state(int(field[-1]), value, device_name)
         elif field == "get" or action == "get":
-            ret += retry(self.single_device_status_update, retries=self.update_retries)(device_name, data)
+            ret += self._update_retry.for_adapter(data.get('iface'))(
+                self.single_device_status_update, device_name, data
+            )
 
         return ret
 
-    def on_command(self, topic, value):
+    def on_command(self, topic, value, route=None):
         _LOGGER.info("On command called with %s %s", topic, value)
-        return retry(self.handle_mqtt_command, retries=self.command_retries)(topic, value)
+        return self._command_retry(self.handle_mqtt_command, topic, value, route)
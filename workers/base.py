@@ -1,14 +1,23 @@
 import logger
 
 import functools
-import logging
+from types import MappingProxyType
 
-import tenacity
+from discovery import SECTION_POLLING, _DISCOVERY_DIGESTS
+from gatt import GattPipeline
+from mqtt import Topic
+from retry_policies import RetryPolicy, _RETRY_BUDGETS, adapter_name
+from worker_state import _WORKER_STATE
 
 _LOGGER = logger.get(__name__)
 
 
 class BaseWorker:
+    _topics = MappingProxyType({})
+    # Workers connecting to their devices get them locked by the manager while
+    # running a status update or command, see device_macs()
+    connects = False
+
     def __init__(self, command_timeout, command_retries, update_retries, global_topic_prefix, **kwargs):
         self.command_timeout = command_timeout
         self.command_retries = command_retries
@@ -43,6 +52,90 @@ class BaseWorker:
             return "{}/{}".format(self.global_topic_prefix, topic)
         return topic
 
+    def make_topic(self, path):
+        """Topic resolved ahead of time for path, relative to the global prefix."""
+        if self.global_topic_prefix:
+            return Topic(path, "{}/{}".format(self.global_topic_prefix, path))
+        return Topic(path, path)
+
+    def build_topic_table(self, attrs, devices=None, extra=()):
+        """Resolve the topics of every device and attribute once, for use by topic().
+
+        :param attrs: attribute names published below each device topic
+        :param devices: device names, defaults to the worker's devices
+        :param extra: topic arguments of topics not below a device, like ("update_interval",)
+        """
+        table = {}
+        for name in self.devices if devices is None else devices:
+            for args in [(name,)] + [(name, attr) for attr in attrs]:
+                table[args] = self.make_topic(self.format_topic(*args))
+        for args in extra:
+            table[tuple(args)] = self.make_topic(self.format_topic(*args))
+        self._topics = MappingProxyType(table)
+
+    def topic(self, *topic_args):
+        """Topic for the arguments from the topic table, resolved now when missing from it."""
+        try:
+            return self._topics[topic_args]
+        except KeyError:
+            return self.make_topic(self.format_topic(*topic_args))
+
+    @staticmethod
+    def changed_discovery(messages):
+        """Drop discovery messages emitted while polling which were already published unchanged."""
+        return _DISCOVERY_DIGESTS.filter(messages, SECTION_POLLING)
+
+    def restore_state(self):
+        """State returned by snapshot_state() before the last restart, None when there is none."""
+        return _WORKER_STATE.restore(repr(self))
+
+    @property
+    def bluetooth_adapter(self):
+        """Adapter set by the worker's adapter, iface or interface argument, None for the default."""
+        for arg in ("adapter", "iface", "interface"):
+            if getattr(self, arg, None) is not None:
+                return adapter_name(getattr(self, arg))
+        return None
+
+    def retry_policy(self, name, retries, exception_type=Exception):
+        """Build a named retry policy sharing the retry budget of the worker's adapter.
+
+        Use for_adapter() on it for devices configured with their own adapter.
+        """
+        return RetryPolicy(
+            "{}.{}".format(repr(self), name),
+            retries=retries,
+            exception_type=exception_type,
+            budget=_RETRY_BUDGETS.get(self.bluetooth_adapter),
+        )
+
+    def device_macs(self):
+        """MACs of the devices the worker connects to, from its devices or mac argument."""
+        if not self.connects:
+            return []
+        devices = getattr(self, "devices", None)
+        if devices is None:
+            return [self.mac] if getattr(self, "mac", None) else []
+        macs = []
+        for device in devices.values():
+            if isinstance(device, str):
+                macs.append(device)
+            elif isinstance(device, dict):
+                macs.append(device["mac"])
+            else:
+                macs.append(device.mac)
+        return macs
+
+    def gatt_pipeline(self, mac, addr_type="public", iface=None):
+        """Queue several GATT operations to run over a single connection to the device."""
+        return GattPipeline(
+            mac,
+            addr_type,
+            iface,
+            lock_timeout=self.command_timeout,
+            description="{} device {}".format(repr(self), mac),
+        )
+
     def __repr__(self):
         return self.__module__.split(".")[-1]
 
@@ -93,24 +186,17 @@ class BaseWorker:
         )
 
 def retry(_func=None, *, retries=0, exception_type=Exception):
-    def log_retry(retry_state):
-        _LOGGER.info(
-                'Call to %s failed the %s time (%s). Retrying in %s seconds',
-                '.'.join((retry_state.fn.__module__, retry_state.fn.__name__)),
-                retry_state.attempt_number,
-                type(retry_state.outcome.exception()).__name__,
-                '{:.2f}'.format(getattr(retry_state.next_action, 'sleep')))
-
+    """Ad-hoc retry decorator, prefer BaseWorker.retry_policy() built once at setup."""
     def decorator_retry(func):
+        policy = RetryPolicy(
+            '.'.join((func.__module__, func.__name__)),
+            retries=retries,
+            exception_type=exception_type,
+        )
+
         @functools.wraps(func)
         def wrapped_retry(*args, **kwargs):
-            retryer = tenacity.Retrying(
-                    wait=tenacity.wait_random(1, 3),
-                    retry=tenacity.retry_if_exception_type(exception_type),
-                    stop=tenacity.stop_after_attempt(retries+1),
-                    reraise=True,
-                    before_sleep=log_retry)
-            return retryer(func, *args, **kwargs)
+            return policy(func, *args, **kwargs)
         return wrapped_retry
 
     if _func:
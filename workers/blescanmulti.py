@@ -29,6 +29,8 @@ class BleDeviceStatus:
         self.available = available
         self.last_status_time = last_status_time
         self.message_sent = message_sent
+        self.topic = worker.make_topic(worker.format_topic("presence", name))
+        self.rssi_topic = worker.make_topic(worker.format_topic("presence", name, "rssi"))
 
     def set_status(self, available):
         if available != self.available:
@@ -58,16 +60,14 @@ class BleDeviceStatus:
             self.message_sent = True
             messages.append(
                 MqttMessage(
-                    topic=self.worker.format_topic("presence/{}".format(self.name)),
+                    topic=self.topic,
                     payload=self.payload(),
                 )
             )
             if self.available:
                 messages.append(
                     MqttMessage(
-                        topic=self.worker.format_topic(
-                            "presence/{}/rssi".format(self.name)
-                        ),
+                        topic=self.rssi_topic,
                         payload=device.rssi,
                     )
                 )
@@ -101,11 +101,24 @@ class BlescanmultiWorker(BaseWorker):
 
         super(BlescanmultiWorker, self).__init__(*args, **kwargs)
         self.scanner = Scanner().withDelegate(ScanDelegate())
+        # Presence survives restarts, devices don't flap to not_home and back
+        state = self.restore_state() or {}
         self.last_status = [
-            BleDeviceStatus(self, mac, name) for name, mac in self.devices.items()
+            BleDeviceStatus(self, mac, name, **state.get(mac.lower(), {}))
+            for name, mac in self.devices.items()
         ]
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
 
+    def snapshot_state(self):
+        return {
+            status.mac: {
+                "available": status.available,
+                "last_status_time": status.last_status_time,
+                "message_sent": status.message_sent,
+            }
+            for status in self.last_status
+        }
+
     def status_update(self):
         from bluepy import btle
 
@@ -6,10 +6,12 @@ Thermometer sends every ~2sec the current temperature.
 """
 import struct
 
+from ble_watchdog import _BLE_WATCHDOG
+from exceptions import DeviceTimeoutError
+from gatt import _HANDLE_CACHE
 from mqtt import MqttMessage
 from workers.base import BaseWorker
 import logger
-import json
 
 _LOGGER = logger.get(__name__)
 
@@ -17,15 +19,15 @@ REQUIREMENTS = ["bluepy"]
 
 
 class IbbqWorker(BaseWorker):
+    connects = True
+
     def _setup(self):
+        self.build_topic_table([])
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.info("Adding %s device '%s' (%s)", repr(self), name, mac)
             self.devices[name] = ibbqThermometer(mac, timeout=self.command_timeout)
 
-    def format_static_topic(self, *args):
-        return "/".join([self.topic_prefix, *args])
-
     def __repr__(self):
         return self.__module__.split(".")[-1]
 
@@ -47,7 +49,7 @@ class IbbqWorker(BaseWorker):
                 ret["Temp{}".format(n)] = i
             return [
                 MqttMessage(
-                    topic=self.format_static_topic(name), payload=json.dumps(ret)
+                    topic=self.topic(name), payload=ret
                 )
             ]
 
@@ -81,16 +83,18 @@ class ibbqThermometer:
     )
 
     def getBattery(self):
-        self.Setting_uuid.write(self.batteryLevel)
+        self.device.writeCharacteristic(self.setting_handle, self.batteryLevel)
 
     def connect(self, timeout=5):
         from bluepy import btle
 
+        device = btle.Peripheral()
         try:
-            device = btle.Peripheral(self.mac)
+            with _BLE_WATCHDOG.deadline(device, timeout, "ibbq {}".format(self.mac)):
+                device.connect(self.mac)
             _LOGGER.debug("%s connected ", self.mac)
             return device
-        except btle.BTLEDisconnectError as er:
+        except (btle.BTLEDisconnectError, DeviceTimeoutError) as er:
             _LOGGER.debug("failed connect %s", er)
 
     def __init__(self, mac, timeout=5):
@@ -142,29 +146,13 @@ class ibbqThermometer:
         if self.device is None:
             return
         try:
-            services = self.device.getServices()
-            for service in services:
-                if "fff0" not in str(service.uuid):
-                    continue
-                for schar in service.getCharacteristics():
-                    if self.AccountAndVerify in str(schar.uuid):
-                        self.account_uuid = schar
-                    if self.RealTimeData in str(schar.uuid):
-                        self.RT_uuid = schar
-                    if self.SettingData in str(schar.uuid):
-                        self.Setting_uuid = schar
-                    if self.SettingResult in str(schar.uuid):
-                        self.SettingResult_uuid = schar
-
-            self.account_uuid.write(self.KEY)
-            _LOGGER.info("Authenticated %s", self.mac)
-            self.RT_uuid.getDescriptors()
-            self.device.writeCharacteristic(self.RT_uuid.getHandle() + 1, self.Notify)
-            self.device.writeCharacteristic(
-                self.SettingResult_uuid.getHandle() + 1, self.Notify
-            )
-            self.getBattery()
-            self.Setting_uuid.write(self.realTimeDataEnable)
+            try:
+                self.enable(self.resolve_handles())
+            except btle.BTLEGattError as ex:
+                # Handles cached from an earlier connection might be stale
+                _LOGGER.debug("%s rediscovering handles after %s", self.mac, ex)
+                _HANDLE_CACHE.invalidate(self.mac)
+                self.enable(self.resolve_handles())
             self.device.withDelegate(MyDelegate(self))
             _LOGGER.info("Subscribed %s", self.mac)
             self.offline = 0
@@ -174,6 +162,22 @@ class ibbqThermometer:
             _LOGGER.info("unsubscribe")
         return self.device
 
+    def resolve_handles(self):
+        return _HANDLE_CACHE.resolve(
+            self.device,
+            self.mac,
+            (self.AccountAndVerify, self.RealTimeData, self.SettingData, self.SettingResult),
+        )
+
+    def enable(self, handles):
+        self.setting_handle = handles[self.SettingData]
+        self.device.writeCharacteristic(handles[self.AccountAndVerify], self.KEY)
+        _LOGGER.info("Authenticated %s", self.mac)
+        self.device.writeCharacteristic(handles[self.RealTimeData] + 1, self.Notify)
+        self.device.writeCharacteristic(handles[self.SettingResult] + 1, self.Notify)
+        self.getBattery()
+        self.device.writeCharacteristic(self.setting_handle, self.realTimeDataEnable)
+
     def update(self):
         from bluepy import btle
 
@@ -185,8 +189,9 @@ class ibbqThermometer:
             if self.cnt > 5:
                 self.cnt = 0
                 self.getBattery()
-            while self.device.waitForNotifications(1):
-                pass
+            with _BLE_WATCHDOG.deadline(self.device, self.timeout, "ibbq {}".format(self.mac)):
+                while self.device.waitForNotifications(1):
+                    pass
             if self.values:
                 self.offline = 0
             else:
@@ -200,7 +205,7 @@ class ibbqThermometer:
                     _LOGGER.debug("%s reconnect", self.mac)
                 else:
                     self.offline += 1
-        except btle.BTLEDisconnectError as e:
+        except (btle.BTLEDisconnectError, DeviceTimeoutError) as e:
             _LOGGER.debug("%s", e)
             self.device = None
         finally:
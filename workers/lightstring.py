@@ -1,6 +1,8 @@
 from builtins import staticmethod
 import logging
 
+from const import DEFAULT_PER_DEVICE_TIMEOUT
+from exceptions import DeviceTimeoutError
 from mqtt import MqttMessage
 
 from workers.base import BaseWorker
@@ -26,71 +28,55 @@ HEX_ENUM_STATE  = "000003"
 HEX_ENUM_CONF   = "02000000"
 
 class LightstringWorker(BaseWorker):
-    def _setup(self):
+    connects = True
+    per_device_timeout = DEFAULT_PER_DEVICE_TIMEOUT  # type: int
 
+    def _setup(self):
+        state = self.restore_state() or {}
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.info("Adding %s device '%s' (%s)", repr(self), name, mac)
-            self.devices[name] = {"lightstring": None, "state": STATE_OFF, "conf": 0, "mac": mac}
-
-    def format_state_topic(self, *args):
-        return "/".join([self.topic_prefix, *args, "state"])
-
-    def format_conf_topic(self, *args):
-        return "/".join([self.topic_prefix, *args, "conf"])
+            saved = state.get(name, {})
+            self.devices[name] = {
+                "lightstring": None,
+                "state": saved.get("state", STATE_OFF),
+                "conf": saved.get("conf", 0),
+                "mac": mac,
+            }
+        self.build_topic_table(["state", "conf"])
+
+    def snapshot_state(self):
+        return {
+            name: {"state": lightstring["state"], "conf": lightstring["conf"]}
+            for name, lightstring in self.devices.items()
+        }
 
     def status_update(self):
         from bluepy import btle
         import binascii
-        from bluepy.btle import Peripheral
 
-        class MyDelegate(btle.DefaultDelegate):
-            def __init__(self):
-                 self.state = ''
-                 btle.DefaultDelegate.__init__(self)
-            def handleNotification(self, cHandle, data):
-                 try:
-                     if data[3] in (0, 3):
-                         self.state = "OFF"
-                     else:
-                         self.state = "ON"
-                 except:
-                     self.state = -1
-
-        class ConfDelegate(btle.DefaultDelegate):
-            def __init__(self):
-                 self.conf = 0
-                 btle.DefaultDelegate.__init__(self)
-            def handleNotification(self, cHandle, data):
-                 try:
-                     self.conf = int(data[17])
-                 except:
-                     self.conf = -1
-
-        delegate = MyDelegate()
-        cdelegate = ConfDelegate()
         ret = []
         _LOGGER.debug("Updating %d %s devices", len(self.devices), repr(self))
         for name, lightstring in self.devices.items():
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, lightstring["mac"])
             try:
-                lightstring["lightstring"] = Peripheral(lightstring["mac"])
-                lightstring["lightstring"].setDelegate(delegate)
-                lightstring["lightstring"].writeCharacteristic(HAND, binascii.a2b_hex(HEX_ENUM_STATE))
-                lightstring["lightstring"].waitForNotifications(1.0)
-                lightstring["lightstring"].disconnect()
-                lightstring["lightstring"].connect(lightstring["mac"])
-                lightstring["lightstring"].setDelegate(cdelegate)
-                lightstring["lightstring"].writeCharacteristic(HAND, binascii.a2b_hex(HEX_ENUM_CONF))
-                lightstring["lightstring"].waitForNotifications(1.0)
-                lightstring["lightstring"].disconnect()
-                if delegate.state != -1:
-                    lightstring["state"] = delegate.state
+                state_notifications, conf_notifications = (
+                    self.gatt_pipeline(lightstring["mac"])
+                    .write(HAND, binascii.a2b_hex(HEX_ENUM_STATE))
+                    .wait_notifications(1.0)
+                    .write(HAND, binascii.a2b_hex(HEX_ENUM_CONF))
+                    .wait_notifications(1.0)
+                    .run(self.per_device_timeout)
+                )
+                state = self.parse_state(state_notifications)
+                conf = self.parse_conf(conf_notifications)
+                if state != -1:
+                    lightstring["state"] = state
                     ret += self.update_device_state(name, lightstring["state"])
-                if cdelegate.conf != -1:
-                    lightstring["conf"] = cdelegate.conf
+                if conf != -1:
+                    lightstring["conf"] = conf
                     ret += self.update_device_conf(name, lightstring["conf"])
-            except btle.BTLEException as e:
+            except (btle.BTLEException, DeviceTimeoutError) as e:
                 logger.log_exception(
                     _LOGGER,
                     "Error during update of %s device '%s' (%s): %s",
@@ -102,12 +88,31 @@ class LightstringWorker(BaseWorker):
                 )
         return ret
 
-    def on_command(self, topic, value):
+    @staticmethod
+    def parse_state(notifications):
+        try:
+            _, data = notifications[-1]
+            return STATE_OFF if data[3] in (0, 3) else STATE_ON
+        except IndexError:
+            return -1
+
+    @staticmethod
+    def parse_conf(notifications):
+        try:
+            _, data = notifications[-1]
+            return int(data[17])
+        except IndexError:
+            return -1
+
+    def on_command(self, topic, value, route=None):
         from bluepy import btle
         import binascii
         from bluepy.btle import Peripheral
 
-        _, _, device_name, _ = topic.split("/")
+        if route is None:
+            _, _, device_name, _ = topic.split("/")
+        else:
+            device_name = route[0]
 
         lightstring = self.devices[device_name]
 
@@ -164,7 +169,7 @@ class LightstringWorker(BaseWorker):
             return []
 
     def update_device_state(self, name, value):
-        return [MqttMessage(topic=self.format_state_topic(name), payload=value)]
+        return [MqttMessage(topic=self.topic(name, "state"), payload=value)]
 
     def update_device_conf(self, name, value):
-        return [MqttMessage(topic=self.format_conf_topic(name), payload=value)]
+        return [MqttMessage(topic=self.topic(name, "conf"), payload=value)]
@@ -13,18 +13,19 @@ REQUIREMENTS = [
 
 
 class LinakdeskWorker(BaseWorker):
-
+    connects = True
     SCAN_TIMEOUT = 20
 
     def _setup(self):
         from linak_dpg_bt import LinakDesk
 
         self.desk = LinakDesk(self.mac)
+        self.build_topic_table([], devices=(), extra=[("height/cm",)])
 
     def status_update(self):
         return [
             MqttMessage(
-                topic=self.format_topic("height/cm"), payload=self._get_height()
+                topic=self.topic("height/cm"), payload=self._get_height()
             )
         ]
 
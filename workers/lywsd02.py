@@ -1,9 +1,10 @@
-import json
 import logger
 
 from contextlib import contextmanager
 from struct import unpack
 
+from ble_watchdog import _BLE_WATCHDOG
+from exceptions import DeviceTimeoutError
 from mqtt import MqttMessage
 from workers.base import BaseWorker
 
@@ -13,11 +14,14 @@ REQUIREMENTS = ["bluepy"]
 
 
 class Lywsd02Worker(BaseWorker):
+    connects = True
+
     def _setup(self):
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.info("Adding %s device '%s' (%s)", repr(self), name, mac)
             self.devices[name] = Lywsd02(mac, timeout=self.command_timeout)
+        self.build_topic_table([])
 
     def status_update(self):
         from bluepy import btle
@@ -25,12 +29,14 @@ class Lywsd02Worker(BaseWorker):
         for name, lywsd02 in self.devices.items():
             try:
                 ret = lywsd02.readAll()
+            except DeviceTimeoutError:
+                self.log_timeout_exception(_LOGGER, name)
             except btle.BTLEDisconnectError as e:
                 self.log_connect_exception(_LOGGER, name, e)
             except btle.BTLEException as e:
                 self.log_unspecified_exception(_LOGGER, name, e)
             else:
-                yield [MqttMessage(topic=self.format_topic(name), payload=json.dumps(ret))]
+                yield [MqttMessage(topic=self.topic(name), payload=ret)]
 
 
 class Lywsd02:
@@ -51,9 +57,10 @@ class Lywsd02:
 
         _LOGGER.debug("%s connected ", self.mac)
         device = btle.Peripheral()
-        device.connect(self.mac)
-        yield device
-        device.disconnect()
+        with _BLE_WATCHDOG.deadline(device, self.timeout, "lywsd02 {}".format(self.mac)):
+            device.connect(self.mac)
+            yield device
+            device.disconnect()
 
     def readAll(self):
         with self.connected() as device:
@@ -1,8 +1,9 @@
-import json
 import logger
 
 from contextlib import contextmanager
 
+from ble_watchdog import _BLE_WATCHDOG
+from exceptions import DeviceTimeoutError
 from mqtt import MqttMessage
 from workers.base import BaseWorker
 
@@ -12,11 +13,14 @@ REQUIREMENTS = ["bluepy"]
 
 class Lywsd03MmcWorker(BaseWorker):
     def _setup(self):
+        # Passive mode only reads advertisements, devices are never connected to
+        self.connects = not self.passive
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
 
         for name, mac in self.devices.items():
             _LOGGER.info("Adding %s device '%s' (%s)", repr(self), name, mac)
             self.devices[name] = lywsd03mmc(mac, command_timeout=self.command_timeout, passive=self.passive)
+        self.build_topic_table([])
 
     def find_device(self, mac):
         for name, device in self.devices.items():
@@ -42,12 +46,14 @@ class Lywsd03MmcWorker(BaseWorker):
         for name, lywsd03mmc in self.devices.items():
             try:
                 ret = lywsd03mmc.readAll()
+            except DeviceTimeoutError:
+                self.log_timeout_exception(_LOGGER, name)
             except btle.BTLEDisconnectError as e:
                 self.log_connect_exception(_LOGGER, name, e)
             except btle.BTLEException as e:
                 self.log_unspecified_exception(_LOGGER, name, e)
             else:
-                yield [MqttMessage(topic=self.format_topic(name), payload=json.dumps(ret))]
+                yield [MqttMessage(topic=self.topic(name), payload=ret)]
 
 
 class lywsd03mmc:
@@ -66,10 +72,11 @@ class lywsd03mmc:
 
         _LOGGER.debug("%s - connected ", self.mac)
         device = btle.Peripheral()
-        device.connect(self.mac)
-        device.writeCharacteristic(0x0038, b'\x01\x00', True)
-        device.writeCharacteristic(0x0046, b'\xf4\x01\x00', True)
-        yield device
+        with _BLE_WATCHDOG.deadline(device, self.command_timeout, "lywsd03mmc {}".format(self.mac)):
+            device.connect(self.mac)
+            device.writeCharacteristic(0x0038, b'\x01\x00', True)
+            device.writeCharacteristic(0x0046, b'\xf4\x01\x00', True)
+            yield device
 
     def readAll(self):
         if self.passive:
@@ -5,7 +5,6 @@ from interruptingcow import timeout
 from workers.base import BaseWorker
 from workers.lywsd03mmc import lywsd03mmc
 import logger
-import json
 import time
 from contextlib import contextmanager
 
@@ -24,6 +23,9 @@ class Lywsd03Mmc_HomeassistantWorker(BaseWorker):
     low batteries. It supports connection retries.
     """
     def _setup(self):
+        # Passive mode only reads advertisements, devices are never connected to
+        self.connects = not self.passive
+        self.build_topic_table(monitoredAttrs + [ATTR_LOW_BATTERY])
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.debug("Adding %s device '%s' (%s)", repr(self), name, mac)
@@ -113,7 +115,7 @@ class Lywsd03Mmc_HomeassistantWorker(BaseWorker):
 
             try:
                 with timeout(self.command_timeout, exception=DeviceTimeoutError):
-                    yield self.update_device_state(name, device)
+                    ret = self.update_device_state(name, device)
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -142,6 +144,8 @@ class Lywsd03Mmc_HomeassistantWorker(BaseWorker):
                     device.mac,
                     suppress=True,
                 )
+            else:
+                yield ret
 
     def update_device_state(self, name, device):
         ret = []
@@ -159,7 +163,7 @@ class Lywsd03Mmc_HomeassistantWorker(BaseWorker):
 
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(name, attr),
+                    topic=self.topic(name, attr),
                     payload=attrValue,
                 )
             )
@@ -167,7 +171,7 @@ class Lywsd03Mmc_HomeassistantWorker(BaseWorker):
         # Low battery binary sensor
         ret.append(
             MqttMessage(
-                topic=self.format_topic(name, ATTR_LOW_BATTERY),
+                topic=self.topic(name, ATTR_LOW_BATTERY),
                 payload=self.true_false_to_ha_on_off(device.getBattery() < 3),
             )
         )
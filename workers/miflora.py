@@ -1,9 +1,9 @@
 from const import DEFAULT_PER_DEVICE_TIMEOUT
 from exceptions import DeviceTimeoutError
-from mqtt import MqttMessage, MqttConfigMessage
+from mqtt import MqttConfigMessage, MqttMessageBatch
 
 from interruptingcow import timeout
-from workers.base import BaseWorker, retry
+from workers.base import BaseWorker
 import logger
 
 REQUIREMENTS = [
@@ -19,12 +19,17 @@ _LOGGER = logger.get(__name__)
 
 
 class MifloraWorker(BaseWorker):
+    connects = True
     per_device_timeout = DEFAULT_PER_DEVICE_TIMEOUT  # type: int
 
     def _setup(self):
         from miflora.miflora_poller import MiFloraPoller
+        from btlewrap import BluetoothBackendException
         from btlewrap.bluepy import BluepyBackend
 
+        self._update_retry = self.retry_policy(
+            "update", self.update_retries, BluetoothBackendException
+        )
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.debug("Adding %s device '%s' (%s)", repr(self), name, mac)
@@ -33,6 +38,7 @@ class MifloraWorker(BaseWorker):
                 "poller": MiFloraPoller(
                     mac, BluepyBackend, adapter=getattr(self, 'adapter', 'hci0')),
             }
+        self.build_topic_table(monitoredAttrs + [ATTR_LOW_BATTERY])
 
     def config(self, availability_topic):
         ret = []
@@ -109,7 +115,7 @@ class MifloraWorker(BaseWorker):
 
             try:
                 with timeout(self.per_device_timeout, exception=DeviceTimeoutError):
-                    yield retry(self.update_device_state, retries=self.update_retries, exception_type=BluetoothBackendException)(name, data["poller"])
+                    ret = self._update_retry(self.update_device_state, name, data["poller"])
             except BluetoothBackendException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -129,12 +135,16 @@ class MifloraWorker(BaseWorker):
                     data["mac"],
                     suppress=True,
                 )
+            else:
+                yield ret
 
     def update_device_state(self, name, poller):
-        ret = []
+        ret = MqttMessageBatch(self.topic, name)
         poller.clear_cache()
-        for attr in monitoredAttrs:
-            payload = poller.parameter_value(attr)
+        # The first lookup fills the poller cache with all sensor values in a
+        # single connection, so read every attribute exactly once.
+        values = {attr: poller.parameter_value(attr) for attr in monitoredAttrs}
+        for attr, payload in values.items():
 
             # We sometimes see light values of over 400 million. This
             # probably comes from a sensor error or maybe the miflora
@@ -147,19 +157,9 @@ class MifloraWorker(BaseWorker):
             if (attr == "light") and (payload > 1_000_000):
                 continue
 
-            ret.append(
-                MqttMessage(
-                    topic=self.format_topic(name, attr),
-                    payload=payload,
-                )
-            )
+            ret.add(attr, payload)
 
         # Low battery binary sensor
-        ret.append(
-            MqttMessage(
-                topic=self.format_topic(name, ATTR_LOW_BATTERY),
-                payload=self.true_false_to_ha_on_off(poller.parameter_value(ATTR_BATTERY) < 10),
-            )
-        )
+        ret.add(ATTR_LOW_BATTERY, self.true_false_to_ha_on_off(values[ATTR_BATTERY] < 10))
 
         return ret
@@ -19,6 +19,15 @@ class MiscaleWorker(BaseWorker):
 
     SCAN_TIMEOUT = 5
 
+    def _setup(self):
+        self.build_topic_table(
+            [],
+            devices=(),
+            extra=[("impedance",), ("midatetime",)]
+            + [("weight", unit) for unit in ("kg", "lbs", "jin")]
+            + [("users", user) for user in getattr(self, "users", {})],
+        )
+
     def getAge(self, d1):
         d1 = datetime.strptime(str(d1), "%Y-%m-%d")
         d2 = datetime.strptime(datetime.today().strftime("%Y-%m-%d"), "%Y-%m-%d")
@@ -29,20 +38,20 @@ class MiscaleWorker(BaseWorker):
 
         messages = [
             MqttMessage(
-                topic=self.format_topic("weight/" + results.unit),
+                topic=self.topic("weight", results.unit),
                 payload=results.weight,
             )
         ]
         if results.impedance:
             messages.append(
                 MqttMessage(
-                    topic=self.format_topic("impedance"), payload=results.impedance
+                    topic=self.topic("impedance"), payload=results.impedance
                 )
             )
         if results.midatetime:
             messages.append(
                 MqttMessage(
-                    topic=self.format_topic("midatetime"), payload=results.midatetime
+                    topic=self.topic("midatetime"), payload=results.midatetime
                 )
             )
 
@@ -91,7 +100,7 @@ class MiscaleWorker(BaseWorker):
 
                     messages.append(
                         MqttMessage(
-                            topic=self.format_topic("users/" + user), payload=metrics
+                            topic=self.topic("users", user), payload=metrics
                         )
                     )
 
@@ -1,9 +1,9 @@
 from const import DEFAULT_PER_DEVICE_TIMEOUT
 from exceptions import DeviceTimeoutError
-from mqtt import MqttMessage, MqttConfigMessage
+from mqtt import MqttConfigMessage, MqttMessageBatch
 from interruptingcow import timeout
 
-from workers.base import BaseWorker, retry
+from workers.base import BaseWorker
 import logger
 
 REQUIREMENTS = ["mithermometer==0.1.4", "bluepy"]
@@ -12,12 +12,17 @@ _LOGGER = logger.get(__name__)
 
 
 class MithermometerWorker(BaseWorker):
+    connects = True
     per_device_timeout = DEFAULT_PER_DEVICE_TIMEOUT  # type: int
 
     def _setup(self):
         from mithermometer.mithermometer_poller import MiThermometerPoller
+        from btlewrap import BluetoothBackendException
         from btlewrap.bluepy import BluepyBackend
 
+        self._update_retry = self.retry_policy(
+            "update", self.update_retries, BluetoothBackendException
+        )
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.debug("Adding %s device '%s' (%s)", repr(self), name, mac)
@@ -25,6 +30,7 @@ class MithermometerWorker(BaseWorker):
                 "mac": mac,
                 "poller": MiThermometerPoller(mac, BluepyBackend),
             }
+        self.build_topic_table(monitoredAttrs)
 
     def config(self, availbility_topic):
         ret = []
@@ -76,7 +82,7 @@ class MithermometerWorker(BaseWorker):
 
             try:
                 with timeout(self.per_device_timeout, exception=DeviceTimeoutError):
-                    yield retry(self.update_device_state, retries=self.update_retries, exception_type=BluetoothBackendException)(name, data["poller"])
+                    ret = self._update_retry(self.update_device_state, name, data["poller"])
             except BluetoothBackendException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -96,15 +102,12 @@ class MithermometerWorker(BaseWorker):
                     data["mac"],
                     suppress=True,
                 )
+            else:
+                yield ret
 
     def update_device_state(self, name, poller):
-        ret = []
+        ret = MqttMessageBatch(self.topic, name)
         poller.clear_cache()
         for attr in monitoredAttrs:
-            ret.append(
-                MqttMessage(
-                    topic=self.format_topic(name, attr),
-                    payload=poller.parameter_value(attr),
-                )
-            )
+            ret.add(attr, poller.parameter_value(attr))
         return ret
@@ -60,6 +60,9 @@ class RuuvitagWorker(BaseWorker):
         for name, mac in self.devices.items():
             _LOGGER.debug("Adding %s device '%s' (%s)", repr(self), name, mac)
             self.devices[name] = RuuviTag(mac)
+        self.build_topic_table(
+            [device_class for _, device_class, _ in ATTR_CONFIG] + [ATTR_LOW_BATTERY]
+        )
 
     def config(self, availability_topic):
         ret = []
@@ -139,7 +142,7 @@ class RuuvitagWorker(BaseWorker):
             try:
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name, device_class),
+                        topic=self.topic(name, device_class),
                         payload=values[attr],
                     )
                 )
@@ -152,7 +155,7 @@ class RuuvitagWorker(BaseWorker):
         try:
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(name, ATTR_LOW_BATTERY),
+                    topic=self.topic(name, ATTR_LOW_BATTERY),
                     payload=self.true_false_to_ha_on_off(
                         values["battery"] < LOW_BATTERY_VOLTAGE
                     ),
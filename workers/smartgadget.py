@@ -15,6 +15,8 @@ _LOGGER = logger.get(__name__)
 
 
 class SmartgadgetWorker(BaseWorker):
+    connects = True
+
     def _setup(self):
         from sensirionbt import SmartGadget
 
@@ -22,6 +24,7 @@ class SmartgadgetWorker(BaseWorker):
         for name, mac in self.devices.items():
             _LOGGER.debug("Adding %s device '%s' (%s)", repr(self), name, mac)
             self.devices[name] = SmartGadget(mac)
+        self.build_topic_table([device_class for _, device_class, _ in ATTR_CONFIG])
 
     def config(self, availability_topic):
         ret = []
@@ -64,7 +67,7 @@ class SmartgadgetWorker(BaseWorker):
         for name, device in self.devices.items():
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, device.mac)
             try:
-                yield self.update_device_state(name, device)
+                ret = self.update_device_state(name, device)
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -75,6 +78,8 @@ class SmartgadgetWorker(BaseWorker):
                     type(e).__name__,
                     suppress=True,
                 )
+            else:
+                yield ret
 
     def update_device_state(self, name, device):
         values = device.get_values()
@@ -83,7 +88,7 @@ class SmartgadgetWorker(BaseWorker):
         for attr, device_class, _ in ATTR_CONFIG:
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(name, device_class), payload=values[attr]
+                    topic=self.topic(name, device_class), payload=values[attr]
                 )
             )
 
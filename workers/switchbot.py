@@ -1,6 +1,7 @@
+from gatt import _HANDLE_CACHE
 from mqtt import MqttMessage
 
-from workers.base import BaseWorker, retry
+from workers.base import BaseWorker
 import logger
 
 REQUIREMENTS = ["bluepy"]
@@ -19,12 +20,21 @@ CHARACTERISTIC_UUID = "cba20002-224d-11e6-9fb8-0002a5d5c51b"
 
 
 class SwitchbotWorker(BaseWorker):
+    connects = True
+
     def _setup(self):
+        self._command_retry = self.retry_policy("command", self.command_retries)
 
+        # The state is only assumed from the commands sent, keep it across restarts
+        state = self.restore_state() or {}
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, mac in self.devices.items():
             _LOGGER.info("Adding %s device '%s' (%s)", repr(self), name, mac)
-            self.devices[name] = {"bot": None, "state": STATE_OFF, "mac": mac}
+            self.devices[name] = {"bot": None, "state": state.get(name, STATE_OFF), "mac": mac}
+        self._state_topics = {name: self.make_topic(self.format_state_topic(name)) for name in self.devices}
+
+    def snapshot_state(self):
+        return {name: bot["state"] for name, bot in self.devices.items()}
 
     def format_state_topic(self, *args):
         return "/".join([self.state_topic_prefix, *args])
@@ -38,15 +48,16 @@ class SwitchbotWorker(BaseWorker):
             ret += self.update_device_state(name, bot["state"])
         return ret
 
-    def on_command(self, topic, value):
+    def on_command(self, topic, value, route=None):
         from bluepy.btle import BTLEException
 
-        _, _, device_name, _ = topic.split("/")
+        if route is None:
+            _, _, device_name, _ = topic.split("/")
+        else:
+            device_name = route[0]
 
         bot = self.devices[device_name]
 
-        switch_func = retry(switch_state, retries=self.command_retries)
-
         value = value.decode("utf-8")
 
         _LOGGER.info(
@@ -69,7 +80,7 @@ class SwitchbotWorker(BaseWorker):
             return []
 
         try:
-            switch_func(bot, value)
+            self._command_retry(switch_state, bot, value)
         except BTLEException as e:
             logger.log_exception(
                 _LOGGER,
@@ -85,7 +96,7 @@ class SwitchbotWorker(BaseWorker):
         return self.update_device_state(device_name, value)
 
     def update_device_state(self, name, value):
-        return [MqttMessage(topic=self.format_state_topic(name), payload=value)]
+        return [MqttMessage(topic=self._state_topics[name], payload=value)]
 
 
 def switch_state(bot, value):
@@ -93,8 +104,8 @@ def switch_state(bot, value):
     from bluepy.btle import Peripheral
 
     bot["bot"] = Peripheral(bot["mac"], "random")
-    hand_service = bot["bot"].getServiceByUUID(SERVICE_UUID)
-    hand = hand_service.getCharacteristics(CHARACTERISTIC_UUID)[0]
-    hand.write(binascii.a2b_hex(CODES[value]))
+    _HANDLE_CACHE.write_characteristic(
+        bot["bot"], bot["mac"], CHARACTERISTIC_UUID, binascii.a2b_hex(CODES[value])
+    )
     bot["bot"].disconnect()
     bot['state'] = STATE_ON if bot['state'] == STATE_OFF else STATE_OFF
@@ -1,6 +1,6 @@
 from mqtt import MqttMessage, MqttConfigMessage
 
-from workers.base import BaseWorker, retry
+from workers.base import BaseWorker
 import logger
 
 REQUIREMENTS = ["python-eq3bt==0.1.12"]
@@ -34,17 +34,27 @@ monitoredAttrs = [
 
 
 class ThermostatWorker(BaseWorker):
+    connects = True
+
     def _setup(self):
+        from bluepy import btle
         from eq3bt import Thermostat
 
+        self._update_retry = self.retry_policy(
+            "update", self.update_retries, btle.BTLEException
+        )
+        self._command_retry = self.retry_policy(
+            "command", self.command_retries, btle.BTLEException
+        )
         _LOGGER.info("Adding %d %s devices", len(self.devices), repr(self))
         for name, obj in self.devices.items():
             if isinstance(obj, str):
-                self.devices[name] = {"mac": obj, "thermostat": Thermostat(obj)}
+                self.devices[name] = {"mac": obj, "thermostat": Thermostat(obj), "interface": None}
             elif isinstance(obj, dict):
                 self.devices[name] = {
                     "mac": obj["mac"],
                     "thermostat": Thermostat(obj["mac"], obj.get("interface")),
+                    "interface": obj.get("interface"),
                     "discovery_temperature_topic": obj.get(
                         "discovery_temperature_topic"
                     ),
@@ -60,6 +70,7 @@ class ThermostatWorker(BaseWorker):
                 name,
                 self.devices[name]["mac"],
             )
+        self.build_topic_table(monitoredAttrs + ["json_attributes", "mode", "preset"])
 
     def config(self, availability_topic):
         ret = []
@@ -197,8 +208,9 @@ class ThermostatWorker(BaseWorker):
         for name, data in self.devices.items():
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, data["mac"])
             thermostat = data["thermostat"]
+            update_retry = self._update_retry.for_adapter(data["interface"])
             try:
-                retry(thermostat.update, retries=self.update_retries, exception_type=btle.BTLEException)()
+                update_retry(thermostat.update)
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -210,20 +222,22 @@ class ThermostatWorker(BaseWorker):
                     suppress=True,
                 )
             else:
-                yield retry(self.present_device_state, retries=self.update_retries, exception_type=btle.BTLEException)(name, thermostat)
+                yield update_retry(self.present_device_state, name, thermostat)
 
-    def on_command(self, topic, value):
+    def on_command(self, topic, value, route=None):
         from bluepy import btle
         from eq3bt import Mode
 
         default_fallback_mode = Mode.Auto
 
-        topic_without_prefix = topic.replace("{}/".format(self.topic_prefix), "")
-        device_name, method, _ = topic_without_prefix.split("/")
+        if route is None:
+            route = topic.replace("{}/".format(self.topic_prefix), "").split("/")
+        device_name, method, _ = route
 
         if device_name in self.devices:
             data = self.devices[device_name]
             thermostat = data["thermostat"]
+            command_retry = self._command_retry.for_adapter(data["interface"])
         else:
             logger.log_exception(_LOGGER, "Ignore command because device %s is unknown", device_name)
             return []
@@ -271,11 +285,11 @@ class ThermostatWorker(BaseWorker):
         try:
             if method == "preset":
                 if value == PRESET_COMFORT:
-                    retry(thermostat.activate_comfort, retries=self.command_retries, exception_type=btle.BTLEException)()
+                    command_retry(thermostat.activate_comfort)
                 else:
-                    retry(thermostat.activate_eco, retries=self.command_retries, exception_type=btle.BTLEException)()
+                    command_retry(thermostat.activate_eco)
             else:
-                retry(setattr, retries=self.command_retries, exception_type=btle.BTLEException)(thermostat, method, value)
+                command_retry(setattr, thermostat, method, value)
         except btle.BTLEException as e:
             logger.log_exception(
                 _LOGGER,
@@ -289,7 +303,7 @@ class ThermostatWorker(BaseWorker):
             )
             return []
 
-        return retry(self.present_device_state, retries=self.command_retries, exception_type=btle.BTLEException)(device_name, thermostat)
+        return command_retry(self.present_device_state, device_name, thermostat)
 
     def present_device_state(self, name, thermostat):
         from eq3bt import Mode
@@ -298,7 +312,7 @@ class ThermostatWorker(BaseWorker):
         attributes = {}
         for attr in monitoredAttrs:
             value = getattr(thermostat, attr)
-            ret.append(MqttMessage(topic=self.format_topic(name, attr), payload=value))
+            ret.append(MqttMessage(topic=self.topic(name, attr), payload=value))
 
             if attr != SENSOR_TARGET_TEMPERATURE:
                 attributes[attr] = value
@@ -310,7 +324,7 @@ class ThermostatWorker(BaseWorker):
 
         ret.append(
             MqttMessage(
-                topic=self.format_topic(name, "json_attributes"), payload=attributes
+                topic=self.topic(name, "json_attributes"), payload=attributes
             )
         )
 
@@ -332,7 +346,7 @@ class ThermostatWorker(BaseWorker):
         else:
             preset = PRESET_NONE
 
-        ret.append(MqttMessage(topic=self.format_topic(name, "mode"), payload=mode))
-        ret.append(MqttMessage(topic=self.format_topic(name, "preset"), payload=preset))
+        ret.append(MqttMessage(topic=self.topic(name, "mode"), payload=mode))
+        ret.append(MqttMessage(topic=self.topic(name, "preset"), payload=preset))
 
         return ret
@@ -10,6 +10,11 @@ _LOGGER = logger.get(__name__)
 
 
 class ToothbrushWorker(BaseWorker):
+    def _setup(self):
+        self.build_topic_table(
+            ["presence", "presence/rssi", "running", "pressure", "time", "mode", "quadrant"]
+        )
+
     def searchmac(self, devices, mac):
         for dev in devices:
             if dev.addr == mac.lower():
@@ -37,47 +42,47 @@ class ToothbrushWorker(BaseWorker):
             if device is None:
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/presence"), payload="0"
+                        topic=self.topic(name, "presence"), payload="0"
                     )
                 )
             else:
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/presence/rssi"),
+                        topic=self.topic(name, "presence/rssi"),
                         payload=device.rssi,
                     )
                 )
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/presence"), payload="1"
+                        topic=self.topic(name, "presence"), payload="1"
                     )
                 )
                 _LOGGER.debug("text: %s" % device.getValueText(255))
                 bytes_ = bytearray(bytes.fromhex(device.getValueText(255)))
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/running"), payload=bytes_[5]
+                        topic=self.topic(name, "running"), payload=bytes_[5]
                     )
                 )
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/pressure"), payload=bytes_[6]
+                        topic=self.topic(name, "pressure"), payload=bytes_[6]
                     )
                 )
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/time"),
+                        topic=self.topic(name, "time"),
                         payload=bytes_[7] * 60 + bytes_[8],
                     )
                 )
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/mode"), payload=bytes_[9]
+                        topic=self.topic(name, "mode"), payload=bytes_[9]
                     )
                 )
                 ret.append(
                     MqttMessage(
-                        topic=self.format_topic(name + "/quadrant"), payload=bytes_[10]
+                        topic=self.topic(name, "quadrant"), payload=bytes_[10]
                     )
                 )
 
@@ -1,5 +1,3 @@
-import json
-
 from mqtt import MqttMessage
 
 from workers.base import BaseWorker
@@ -50,7 +48,7 @@ BRUSHSECTORS = {
 
 class Toothbrush_HomeassistantWorker(BaseWorker):
     def _setup(self):
-        self.autoconfCache = {}
+        self.build_topic_table(["presence", "state", "attributes"])
 
     def searchmac(self, devices, mac):
         for dev in devices:
@@ -59,18 +57,14 @@ class Toothbrush_HomeassistantWorker(BaseWorker):
         return None
 
     def get_autoconf_data(self, key, name):
-        if key in self.autoconfCache:
-            return False
-        else:
-            self.autoconfCache[key] = True
-            return {
-                "platform": "mqtt",
-                "name": name,
-                "state_topic": self.topic_prefix + "/" + key + "/state",
-                "availability_topic": self.topic_prefix + "/" + key + "/presence",
-                "json_attributes_topic": self.topic_prefix + "/" + key + "/attributes",
-                "icon": "mdi:tooth-outline",
-            }
+        return {
+            "platform": "mqtt",
+            "name": name,
+            "state_topic": self.topic_prefix + "/" + key + "/state",
+            "availability_topic": self.topic_prefix + "/" + key + "/presence",
+            "json_attributes_topic": self.topic_prefix + "/" + key + "/attributes",
+            "icon": "mdi:tooth-outline",
+        }
 
     def get_state(self, item):
         if item in BRUSHSTATES:
@@ -140,25 +134,24 @@ class Toothbrush_HomeassistantWorker(BaseWorker):
 
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(key + "/presence"), payload=presence_value
+                    topic=self.topic(key, "presence"), payload=presence_value
                 )
             )
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(key + "/state"),
+                    topic=self.topic(key, "state"),
                     payload=self.get_state(state),
                 )
             )
             ret.append(
                 MqttMessage(
-                    topic=self.format_topic(key + "/attributes"),
-                    payload=json.dumps(attributes),
+                    topic=self.topic(key, "attributes"),
+                    payload=attributes,
                 )
             )
 
-            autoconf_data = self.get_autoconf_data(key, item["name"])
-            if autoconf_data != False:
-                ret.append(
+            ret += self.changed_discovery(
+                [
                     MqttMessage(
                         topic=self.autodiscovery_prefix
                         + "/sensor/"
@@ -166,9 +159,10 @@ class Toothbrush_HomeassistantWorker(BaseWorker):
                         + "_"
                         + key
                         + "/config",
-                        payload=json.dumps(autoconf_data),
+                        payload=self.get_autoconf_data(key, item["name"]),
                         retain=True,
                     )
-                )
+                ]
+            )
 
             yield ret
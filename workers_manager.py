@@ -1,14 +1,41 @@
 import importlib
 import inspect
+import os
 import threading
+import time
+from contextlib import ExitStack
 from functools import partial
+from itertools import zip_longest
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from interruptingcow import timeout
 from pytz import utc
 
-from const import DEFAULT_COMMAND_TIMEOUT, DEFAULT_COMMAND_RETRIES, DEFAULT_UPDATE_RETRIES
+from const import (
+    DEFAULT_COMMAND_DEBOUNCE,
+    DEFAULT_COMMAND_MAX_AGE,
+    DEFAULT_COMMAND_TIMEOUT,
+    DEFAULT_COMMAND_RETRIES,
+    DEFAULT_DISCOVERY_RATE,
+    DEFAULT_UPDATE_RETRIES,
+    DEFAULT_METRICS_INTERVAL,
+    DEFAULT_REFRESH_MAX_AGE,
+    DEFAULT_REFRESH_STAGGER,
+    DEFAULT_REPUBLISH_CHUNK,
+    DEFAULT_REPUBLISH_INTERVAL,
+    DEFAULT_RETRY_BUDGET,
+    DEFAULT_STATE_DIR,
+    DEFAULT_STATE_SNAPSHOT_INTERVAL,
+    DEFAULT_STATE_SNAPSHOT_MAX_AGE,
+)
+from device_locks import _DEVICE_LOCKS
+from discovery import MODE_ENTITY, _DISCOVERY_DIGESTS, DiscoveryPublisher
 from exceptions import WorkerTimeoutError
+from gatt import _HANDLE_CACHE
+from metrics import _METRICS
+from mqtt import MqttMessage
+from retry_policies import _RETRY_BUDGETS
+from worker_state import _WORKER_STATE
 from workers_queue import _WORKERS_QUEUE
 import logger
 
@@ -17,11 +44,20 @@ _LOGGER = logger.get(__name__)
 
 class WorkersManager:
     class Command:
-        def __init__(self, callback, timeout, args=(), options=dict()):
+        def __init__(self, callback, timeout, args=(), options=dict(), max_age=None, devices=()):
             self._callback = callback
             self._timeout = timeout
             self._args = args
             self._options = options
+            self._max_age = max_age
+            # Locked in a fixed order, so two commands sharing devices can't dead-lock
+            self._devices = sorted({mac.upper() for mac in devices})
+            self._cancelled = False
+            # Set when a generator timed out and only part of its messages were returned
+            self.timed_out = False
+            self.created = time.monotonic()
+            # When the command last ran to completion, None until it did
+            self.completed = None
             self._source = "{}.{}".format(
                 callback.__self__.__class__.__name__
                 if hasattr(callback, "__self__")
@@ -29,9 +65,28 @@ class WorkersManager:
                 callback.__name__,
             )
 
+        def cancel(self):
+            """Skip the command when it gets executed, e.g. because a newer one superseded it."""
+            self._cancelled = True
+
+        @property
+        def cancelled(self):
+            return self._cancelled
+
         def execute(self):
             messages = []
 
+            if self._cancelled:
+                _LOGGER.debug("Skipping cancelled command %s", self._source)
+                return messages
+            age = time.monotonic() - self.created
+            if self._max_age and age > self._max_age:
+                _METRICS.increment("commands.expired")
+                _LOGGER.warning(
+                    "Dropping command %s, it waited %.1f seconds to be executed", self._source, age
+                )
+                return messages
+
             try:
                 with timeout(
                         self._timeout,
@@ -40,7 +95,9 @@ class WorkersManager:
                                 self._source, self._timeout
                             )
                         ),
-                ):
+                ), ExitStack() as locks:
+                    for mac in self._devices:
+                        locks.enter_context(_DEVICE_LOCKS.acquire(mac, timeout=self._timeout))
                     if inspect.isgeneratorfunction(self._callback):
                         for message in self._callback(*self._args):
                             messages += message
@@ -48,18 +105,52 @@ class WorkersManager:
                         messages = self._callback(*self._args)
             except WorkerTimeoutError as e:
                 if messages:
+                    self.timed_out = True
                     logger.log_exception(
                         _LOGGER, "%s, sending only partial update", e, suppress=True
                     )
                 else:
                     raise e
 
+            self.completed = time.monotonic()
             _LOGGER.debug("Execution result of command %s: %s", self._source, messages)
             return messages
 
+    class ConfigCommand(Command):
+        """Command whose messages go to the discovery publisher instead of the main loop."""
+
+        def __init__(self, callback, timeout, args, discovery):
+            super().__init__(callback, timeout, args)
+            self._discovery = discovery
+            # Called once the configs were published, set by the manager
+            self.then = None
+
+        def execute(self):
+            messages = None
+            self.timed_out = False
+            try:
+                messages = super().execute()
+            finally:
+                self._discovery.add(messages, complete=not self.timed_out, then=self.then)
+            return []
+
+    class DeviceCommand(Command):
+        """Command for one device and action, released from coalescing once it runs."""
+
+        def __init__(self, callback, timeout, args, max_age, release, devices=()):
+            super().__init__(callback, timeout, args, max_age=max_age, devices=devices)
+            self._release = release
+
+        def execute(self):
+            # A newer command must not cancel one already running
+            self._release(self)
+            return super().execute()
+
     def __init__(self, config, mqtt_config):
         self._mqtt_callbacks = []
         self._config_commands = []
+        # Update commands first queued once their worker's configs were published
+        self._deferred_updates = []
         self._update_commands = []
         self._scheduler = BackgroundScheduler(timezone=utc)
         self._daemons = []
@@ -67,7 +158,33 @@ class WorkersManager:
         self._command_timeout = config.get("command_timeout", DEFAULT_COMMAND_TIMEOUT)
         self._command_retries = config.get("command_retries", DEFAULT_COMMAND_RETRIES)
         self._update_retries = config.get("update_retries", DEFAULT_UPDATE_RETRIES)
+        self._command_debounce = config.get("command_debounce", DEFAULT_COMMAND_DEBOUNCE)
+        self._command_max_age = config.get("command_max_age", DEFAULT_COMMAND_MAX_AGE)
+        self._pending_commands = {}
+        self._pending_commands_lock = threading.Lock()
+        republish = config.get("republish", {})
+        self._refresh_max_age = republish.get("max_age", DEFAULT_REFRESH_MAX_AGE)
+        self._refresh_stagger = republish.get("stagger", DEFAULT_REFRESH_STAGGER)
+        self._republish_chunk = republish.get("chunk", DEFAULT_REPUBLISH_CHUNK)
+        self._republish_interval = republish.get("chunk_interval", DEFAULT_REPUBLISH_INTERVAL)
         self._mqtt = mqtt_config
+        self._state_dir = config.get("state_dir", DEFAULT_STATE_DIR)
+        _RETRY_BUDGETS.configure(config.get("retry_budget", DEFAULT_RETRY_BUDGET))
+        _HANDLE_CACHE.configure(os.path.join(self._state_dir, "gatt_handles.json"))
+        _DISCOVERY_DIGESTS.configure(os.path.join(self._state_dir, "discovery.json"), self._mqtt.names)
+        self._state_snapshot = config.get("state_snapshot")
+        if self._state_snapshot is not None:
+            _WORKER_STATE.configure(os.path.join(self._state_dir, "worker_state.json"))
+        self._discovery = None
+        if "sensor_config" in config:
+            sensor_config = config["sensor_config"]
+            self._discovery = DiscoveryPublisher(
+                self._mqtt,
+                topic=sensor_config.get("topic", "homeassistant"),
+                retain=sensor_config.get("retain", True),
+                mode=sensor_config.get("mode", MODE_ENTITY),
+                rate=sensor_config.get("rate", DEFAULT_DISCOVERY_RATE),
+            )
 
     def register_workers(self, global_topic_prefix):
         for (worker_name, worker_config) in self._config["workers"].items():
@@ -87,12 +204,20 @@ class WorkersManager:
                 command_timeout, command_retries, update_retries, global_topic_prefix, **worker_config["args"]
             )
 
-            if "sensor_config" in self._config and hasattr(worker_obj, "config"):
+            if "payload_codec" in worker_config:
+                self._mqtt.add_payload_codec(
+                    worker_obj.format_topic("#"), worker_config["payload_codec"]
+                )
+
+            config_command = None
+            if self._discovery and hasattr(worker_obj, "config"):
                 _LOGGER.debug(
                     "Added %s config with a %d seconds timeout", repr(worker_obj), 2
                 )
-                command = self.Command(worker_obj.config, 2, [self._mqtt.availability_topic])
-                self._config_commands.append(command)
+                config_command = self.ConfigCommand(
+                    worker_obj.config, 2, [self._mqtt.availability_topic], self._discovery
+                )
+                self._config_commands.append(config_command)
 
             if hasattr(worker_obj, "status_update"):
                 _LOGGER.debug(
@@ -102,11 +227,19 @@ class WorkersManager:
                     worker_obj.command_timeout,
                 )
                 command = self.Command(
-                    worker_obj.status_update, worker_obj.command_timeout, []
+                    worker_obj.status_update,
+                    worker_obj.command_timeout,
+                    [],
+                    devices=worker_obj.device_macs(),
                 )
                 self._update_commands.append(command)
+                if config_command is not None:
+                    # Home Assistant only accepts states of entities it got the config of
+                    config_command.then = partial(self._queue_first_update, command)
+                    self._deferred_updates.append(command)
 
                 if "update_interval" in worker_config:
+                    self._restore_update(worker_obj, command)
                     job_id = "{}_interval_job".format(worker_name)
                     self._scheduler.add_job(
                         partial(self._queue_command, command),
@@ -122,15 +255,28 @@ class WorkersManager:
                     )
             elif hasattr(worker_obj, "run"):
                 _LOGGER.debug("Registered %s as daemon", repr(worker_obj))
-                self._daemons.append(worker_obj)
+                if config_command is not None:
+                    config_command.then = partial(self._start_daemon, worker_obj)
+                else:
+                    self._daemons.append(worker_obj)
             else:
                 raise "%s cannot be initialized, it has to define run or status_update method" % worker_name
 
+            if self._state_snapshot is not None and hasattr(worker_obj, "snapshot_state"):
+                _WORKER_STATE.register(repr(worker_obj), worker_obj.snapshot_state)
+
             if "topic_subscription" in worker_config:
+                # Levels of the worker's own prefix, the rest of the topic is its
+                # route. Only passed to workers whose on_command takes it.
+                route_offset = (
+                    len(worker_obj.format_prefixed_topic().split("/"))
+                    if hasattr(worker_obj, "topic_prefix") and self._accepts_route(worker_obj.on_command)
+                    else None
+                )
                 self._mqtt_callbacks.append(
                     (
                         worker_config["topic_subscription"],
-                        partial(self._on_command_wrapper, worker_obj),
+                        partial(self._on_command_wrapper, worker_obj, route_offset),
                     )
                 )
 
@@ -139,11 +285,9 @@ class WorkersManager:
                 self._mqtt_callbacks.append(
                     (
                         options["topic"],
-                        lambda client, _, c: self._queue_if_matching_payload(
-                            self.Command(
-                                getattr(self, callback_name), self._command_timeout
-                            ),
-                            c.payload,
+                        partial(
+                            self._on_subscription_wrapper,
+                            getattr(self, callback_name),
                             options["payload"],
                         ),
                     )
@@ -152,28 +296,134 @@ class WorkersManager:
     def start(self):
         self._mqtt.callbacks_subscription(self._mqtt_callbacks)
 
-        if "sensor_config" in self._config:
-            self._publish_config()
+        if "metrics" in self._config:
+            self._scheduler.add_job(
+                partial(
+                    self._queue_command,
+                    self.Command(self.report_metrics, self._command_timeout),
+                ),
+                "interval",
+                seconds=self._config["metrics"].get("interval", DEFAULT_METRICS_INTERVAL),
+                id="metrics_job",
+            )
+
+        if self._state_snapshot is not None:
+            self._scheduler.add_job(
+                partial(
+                    self._queue_command,
+                    self.Command(self.save_state, self._command_timeout),
+                ),
+                "interval",
+                seconds=self._state_snapshot.get("interval", DEFAULT_STATE_SNAPSHOT_INTERVAL),
+                id="state_snapshot_job",
+            )
 
         self._scheduler.start()
-        self.update_all()
+        if self._discovery:
+            self._discovery.expect(len(self._config_commands))
+        # Config commands only build payloads, so queue them between the first
+        # polls; the configs themselves are published in the background, and
+        # a worker with configs is first polled once they were published.
+        # Workers restored from a fresh state snapshot wait for their next interval.
+        update_commands = [
+            command
+            for command in self._update_commands
+            if command.completed is None and command not in self._deferred_updates
+        ]
+        for commands in zip_longest(self._config_commands, update_commands):
+            for command in commands:
+                if command is not None:
+                    self._queue_command(command)
         for daemon in self._daemons:
-            threading.Thread(target=daemon.run, args=[self._mqtt], daemon=True).start()
+            self._start_daemon(daemon)
+
+    def _start_daemon(self, daemon):
+        threading.Thread(target=daemon.run, args=[self._mqtt], daemon=True).start()
+
+    def _queue_first_update(self, command):
+        if command.completed is None:
+            self._queue_command(command)
 
     def _queue_if_matching_payload(self, command, payload, expected_payload):
         if payload.decode("utf-8") == expected_payload:
             self._queue_command(command)
 
+    def _on_subscription_wrapper(self, callback, expected_payload, client, userdata, c, levels):
+        self._queue_if_matching_payload(
+            self.Command(callback, self._command_timeout), c.payload, expected_payload
+        )
+
     def update_all(self):
         _LOGGER.debug("Updating all workers")
+        self._mqtt.last_values.invalidate()
         for command in self._update_commands:
             self._queue_command(command)
 
+    def republish_all(self):
+        """Republish the last known values right away, then refresh only the stale workers.
+
+        Lighter alternative to update_all, which polls every device at once.
+        """
+        _LOGGER.debug("Republishing the last values of all workers")
+        # Discovery configs are published by the discovery publisher, never from the cache
+        exclude = [self._discovery.topic_filter] if self._discovery else []
+        self._mqtt.republish(exclude, self._republish_chunk, self._republish_interval)
+
+        now = time.monotonic()
+        stale = [
+            command
+            for command in self._update_commands
+            if command.completed is None or now - command.completed > self._refresh_max_age
+        ]
+        _LOGGER.debug("Refreshing %d workers with stale values", len(stale))
+        # One worker at a time, so the refresh does not compete with commands
+        for index, command in enumerate(stale, 1):
+            timer = threading.Timer(
+                index * self._refresh_stagger, self._queue_if_stale, [command]
+            )
+            timer.daemon = True
+            timer.start()
+
+    def save_state(self):
+        _WORKER_STATE.save()
+        return []
+
+    def report_metrics(self):
+        topic = self._config["metrics"].get("topic")
+        if not topic:
+            _METRICS.log()
+            return []
+        return [MqttMessage(topic=topic, payload=_METRICS.snapshot())]
+
+    def _restore_update(self, worker_obj, command):
+        """Skip the first update of a worker restored from a fresh snapshot, its interval job polls it later."""
+        if self._state_snapshot is None or not hasattr(worker_obj, "snapshot_state"):
+            return
+        age = _WORKER_STATE.age(repr(worker_obj))
+        if age is not None and age < self._state_snapshot.get("max_age", DEFAULT_STATE_SNAPSHOT_MAX_AGE):
+            _LOGGER.info("Restored %s from a %d seconds old state snapshot", repr(worker_obj), age)
+            # Counts as the last update, for republish_all too
+            command.completed = time.monotonic() - age
+
     @staticmethod
     def _queue_command(command):
         _WORKERS_QUEUE.put(command)
 
-    def _update_interval_wrapper(self, command, job_id, client, userdata, c):
+    def _queue_if_not_cancelled(self, command):
+        if not command.cancelled:
+            self._queue_command(command)
+
+    def _queue_if_stale(self, command):
+        # The interval job may have refreshed it in the meantime
+        if command.completed is None or time.monotonic() - command.completed > self._refresh_max_age:
+            self._queue_command(command)
+
+    def _release_command(self, key, command):
+        with self._pending_commands_lock:
+            if self._pending_commands.get(key) is command:
+                del self._pending_commands[key]
+
+    def _update_interval_wrapper(self, command, job_id, client, userdata, c, levels):
         _LOGGER.info("Recieved updated interval for %s with: %s", c.topic, c.payload)
         try:
             new_interval = int(c.payload)
@@ -189,7 +439,20 @@ class WorkersManager:
                 _LOGGER, "Ignoring invalid new interval: %s", c.payload
             )
 
-    def _on_command_wrapper(self, worker_obj, client, userdata, c):
+    @staticmethod
+    def _accepts_route(on_command):
+        """Whether on_command takes the route as third positional argument."""
+        try:
+            parameters = inspect.signature(on_command).parameters.values()
+        except (TypeError, ValueError):
+            return False
+        positional = [
+            p for p in parameters
+            if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD, p.VAR_POSITIONAL)
+        ]
+        return len(positional) >= 3 or any(p.kind == p.VAR_POSITIONAL for p in positional)
+
+    def _on_command_wrapper(self, worker_obj, route_offset, client, userdata, c, levels):
         _LOGGER.debug(
             "Received command for %s on %s: %s", repr(worker_obj), c.topic, c.payload
         )
@@ -199,19 +462,31 @@ class WorkersManager:
             if global_topic_prefix is not None
             else c.topic
         )
-        self._queue_command(
-            self.Command(
-                worker_obj.on_command, worker_obj.command_timeout, [topic, c.payload]
-            )
+        # Last write wins: a newer command for the same device and action
+        # replaces one still waiting to be executed
+        key = (repr(worker_obj), topic)
+        args = [topic, c.payload]
+        if route_offset is not None:
+            args.append(levels[route_offset:])
+        command = self.DeviceCommand(
+            worker_obj.on_command,
+            worker_obj.command_timeout,
+            args,
+            self._command_max_age,
+            partial(self._release_command, key),
+            devices=worker_obj.device_macs(),
         )
+        with self._pending_commands_lock:
+            # Only holds commands not running yet, see _release_command
+            superseded = self._pending_commands.get(key)
+            self._pending_commands[key] = command
+            if superseded is not None:
+                superseded.cancel()
+                _METRICS.increment("commands.coalesced")
 
-    def _publish_config(self):
-        for command in self._config_commands:
-            messages = command.execute()
-            for msg in messages:
-                msg.topic = "{}/{}".format(
-                    self._config["sensor_config"].get("topic", "homeassistant"),
-                    msg.topic,
-                )
-                msg.retain = self._config["sensor_config"].get("retain", True)
-            self._mqtt.publish(messages)
+        if self._command_debounce:
+            timer = threading.Timer(self._command_debounce, self._queue_if_not_cancelled, [command])
+            timer.daemon = True
+            timer.start()
+        else:
+            self._queue_command(command)